@@ -1,10 +1,19 @@
 import streamlit as st
-from PIL import Image
-import subprocess
 import os
-import zipfile
 import json
-from io import BytesIO
+import logging
+import tempfile
+import time
+import uuid
+from archive import StreamingZip
+from job_queue import JobQueue, ACTIVE_STATUSES
+from result_cache import ResultCache
+from video_scheduler import throughput_summary
+from metrics import REGISTRY, format_stages
+from image_compressor import output_name, AVIF_AVAILABLE
+from dedup import DEFAULT_MAX_DISTANCE
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 # File to store user credentials
 USER_FILE = "users.json"
@@ -59,8 +68,15 @@ def delete_user(username_to_delete):
     else:
         st.error("User not found!")
 
+# Close the session's download archives (all but `keep`)
+def close_archives(keep=None):
+    archives = st.session_state.get('archives', {})
+    for batch_id in [batch_id for batch_id in archives if batch_id != keep]:
+        archives.pop(batch_id).close()
+
 # Logout Function
 def logout():
+    close_archives()
     st.session_state['authenticated'] = False
     st.session_state['admin'] = False
     st.session_state['current_user'] = None
@@ -114,6 +130,10 @@ if st.session_state['admin']:
     st.sidebar.write("### Current Users")
     st.sidebar.table({"Username": list(st.session_state['user_passwords'].keys())})
 
+    # Metrics Snapshot (Prometheus text format)
+    with st.sidebar.expander("📈 Metrics"):
+        st.code(REGISTRY.prometheus_text(), language="text")
+
 # Logout Button
 st.sidebar.button("🚪 Logout", on_click=logout)
 
@@ -128,52 +148,28 @@ if st.session_state['admin']:
 st.title(f"Welcome, {st.session_state['current_user']} 👋")
 st.write("Advanced Image and Video Compressor")
 
-# Helper Function: Compress Single Image
-def compress_image(input_path, output_path, quality=75, resize=False, width=None, height=None):
-    try:
-        before_size = os.path.getsize(input_path) // 1024  # Size in KB
-        with Image.open(input_path) as img:
-            if resize and width and height:
-                img = img.resize((width, height))
-            img = img.convert("RGB")
-            img.save(output_path, format="JPEG", optimize=True, quality=quality)
-        after_size = os.path.getsize(output_path) // 1024
-        return before_size, after_size
-    except Exception as e:
-        st.error(f"Error compressing image: {e}")
-        return None, None
-
-# Helper Function: Compress Single Video
-def compress_video(input_path, output_path, crf=23, resolution=None, bitrate=None):
-    ffmpeg_path = r"C:\Users\HP\Desktop\imgvid\ffmpeg-7.1-full_build\ffmpeg-7.1-full_build\bin\ffmpeg.exe"
-    try:
-        before_size = os.path.getsize(input_path) // 1024  # Size in KB
-
-        # FFmpeg compression command
-        command = [ffmpeg_path, "-y", "-i", input_path, "-vcodec", "libx264", "-crf", str(crf)]
-
-        # Add resolution and bitrate options
-        if resolution:
-            command += ["-vf", f"scale={resolution}"]
-        if bitrate:
-            command += ["-b:v", bitrate]
-
-        command.append(output_path)
-
-        subprocess.run(command, capture_output=True, text=True, check=True)
-        after_size = os.path.getsize(output_path) // 1024
-        return before_size, after_size
-    except subprocess.CalledProcessError as e:
-        st.error(f"FFmpeg Error: {e.stderr}")
-        return None, None
-
-# Helper Function: Create ZIP File
-def create_zip(file_paths):
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w") as zf:
-        for file_path in file_paths:
-            zf.write(file_path, os.path.basename(file_path))
-    return zip_buffer
+# Shared Result Cache (survives reruns, so re-uploads are never recompressed)
+@st.cache_resource
+def get_result_cache():
+    return ResultCache()
+
+# Shared Job Queue (background workers shared fairly by all sessions)
+JOBS_DIR = os.path.join(tempfile.gettempdir(), "compressor_jobs")
+POLL_SECONDS = 1.0
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(cache=get_result_cache())
+
+# Helper Function: Per-Batch ZIP, filled in as each job finishes. Only the
+# selected batch's archive is kept; switching batches closes the others.
+def batch_archive(batch_id):
+    close_archives(keep=batch_id)
+    archives = st.session_state.setdefault('archives', {})
+    if batch_id not in archives:
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        archives[batch_id] = StreamingZip(spool_dir=JOBS_DIR)
+    return archives[batch_id]
 
 # Streamlit UI
 st.title("Advanced Image and Video Compressor")
@@ -184,8 +180,24 @@ compression_quality = st.sidebar.slider("Compression Quality", 10, 100, 75)
 resize_image = st.sidebar.checkbox("Resize Images")
 custom_width = st.sidebar.number_input("Width (px)", min_value=100, step=50, value=800)
 custom_height = st.sidebar.number_input("Height (px)", min_value=100, step=50, value=600)
+image_format = st.sidebar.selectbox("Image Format", ["JPEG", "WEBP"] + (["AVIF"] if AVIF_AVAILABLE else []) + ["Auto"])
+exact_resize = st.sidebar.checkbox("Exact LANCZOS Resize (slower)")
+target_size_kb = st.sidebar.number_input("Target Image Size (KB, 0 = off)", min_value=0, step=50, value=0)
+min_ssim = st.sidebar.number_input("Minimum SSIM (0 = off)", min_value=0.0, max_value=0.999, step=0.005, value=0.0, format="%.3f")
+reuse_duplicates = st.sidebar.checkbox("Compress Near-Duplicate Images Once")
+dedup_distance = st.sidebar.slider("Near-Duplicate Distance (bits)", 0, 20, DEFAULT_MAX_DISTANCE)
 resolution_option = st.sidebar.selectbox("Video Resolution", ["None", "1920x1080", "1280x720", "640x480"])
 bitrate_option = st.sidebar.text_input("Video Bitrate (e.g., 1000k)", "")
+skip_unshrinkable = st.sidebar.checkbox("Skip Videos That Won't Shrink",
+                                        help="Sample-encodes each video first, which needs a seekable copy on disk: "
+                                             "uploads are then written to a temporary file instead of being piped "
+                                             "straight through ffmpeg from memory.")
+min_savings_percent = st.sidebar.slider("Minimum Predicted Savings (%)", 0, 50, 10)
+segmented_encoding = st.sidebar.checkbox("Segmented Encoding For Long Videos",
+                                         help="Also writes uploads to a temporary file before encoding.")
+if skip_unshrinkable or segmented_encoding:
+    st.sidebar.caption("Videos are spooled to disk for pre-flight/segmented encoding; turn both off to stream "
+                       "uploads through ffmpeg in memory.")
 
 compression_type = st.sidebar.radio("Select Compression Type", ["Images", "Videos"])
 
@@ -195,59 +207,120 @@ uploaded_files = st.file_uploader("Drag and Drop or Browse Files",
                                   accept_multiple_files=True)
 
 # Process Uploaded Files
+job_queue = get_job_queue()
+current_user = st.session_state['current_user']
 if uploaded_files:
     st.write("### Uploaded Files:")
-    file_paths = []
     for uploaded_file in uploaded_files:
-        temp_path = f"temp_{uploaded_file.name}"
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        file_paths.append(temp_path)
         st.write(f"✅ {uploaded_file.name}")
 
-    output_files = []
-    size_data = []
-    progress_bar = st.progress(0)
-
     if st.button("Compress Files"):
-        total_files = len(file_paths)
-        for idx, file_path in enumerate(file_paths):
-            file_ext = os.path.splitext(file_path)[1].lower()
-            output_path = f"compressed_{os.path.basename(file_path)}"
-            before_size, after_size = None, None
-
-            # Image Compression
+        # Uploads go to the workers straight from memory; only outputs are written,
+        # to a per-batch folder the queue purges once the batch has expired
+        batch_dir = os.path.join(JOBS_DIR, uuid.uuid4().hex)
+        os.makedirs(batch_dir)
+        jobs = []
+        for uploaded_file in uploaded_files:
+            file_ext = os.path.splitext(uploaded_file.name)[1].lower()
             if file_ext in [".jpg", ".jpeg", ".png"]:
-                before_size, after_size = compress_image(
-                    file_path, output_path, quality=compression_quality,
-                    resize=resize_image, width=custom_width, height=custom_height
-                )
-            # Video Compression
+                jobs.append(("image", uploaded_file, os.path.join(batch_dir, output_name(uploaded_file.name, image_format))))
             elif file_ext in [".mp4", ".avi"]:
-                before_size, after_size = compress_video(
-                    file_path, output_path, crf=23, resolution=resolution_option if resolution_option != "None" else None,
-                    bitrate=bitrate_option if bitrate_option else None
-                )
+                # Piped video comes back as fragmented MP4
+                stem = os.path.splitext(uploaded_file.name)[0]
+                jobs.append(("video", uploaded_file, os.path.join(batch_dir, f"compressed_{stem}.mp4")))
             else:
-                st.warning(f"Unsupported file format: {file_path}")
-                continue
-
-            if before_size and after_size:
-                size_data.append([os.path.basename(file_path), before_size, after_size, round((before_size - after_size) / before_size * 100, 2)])
-                output_files.append(output_path)
-
-            # Update progress
-            progress_bar.progress((idx + 1) / total_files)
-
-        # Show Size Comparison Table
-        if size_data:
-            st.write("### Before and After Size Comparison:")
-            st.table({"File Name": [row[0] for row in size_data],
-                      "Before Size (KB)": [row[1] for row in size_data],
-                      "After Size (KB)": [row[2] for row in size_data],
-                      "Saved (%)": [row[3] for row in size_data]})
-
-        # ZIP and Download
-        if output_files:
-            zip_buffer = create_zip(output_files)
-            st.download_button("Download All as ZIP", data=zip_buffer.getvalue(), file_name="compressed_files.zip", mime="application/zip")
+                st.warning(f"Unsupported file format: {uploaded_file.name}")
+        if jobs:
+            job_queue.submit(current_user, jobs, dedup_distance=dedup_distance if reuse_duplicates else None,
+                             image={"quality": compression_quality, "resize": resize_image, "width": custom_width,
+                                    "height": custom_height, "exact": exact_resize,
+                                    "target_bytes": int(target_size_kb) * 1024 or None,
+                                    "output_format": image_format, "min_ssim": min_ssim or None},
+                             video={"crf": 23, "resolution": resolution_option if resolution_option != "None" else None,
+                                    "bitrate": bitrate_option if bitrate_option else None,
+                                    "preflight": skip_unshrinkable, "min_savings": min_savings_percent / 100,
+                                    "segmented": segmented_encoding})
+
+# Job Status (read back from the job table, so it survives reruns and reloads)
+user_jobs = job_queue.jobs(current_user)
+if user_jobs:
+    batches = list(dict.fromkeys(job["batch_id"] for job in user_jobs))
+    batch_created = {job["batch_id"]: job["created"] for job in user_jobs}
+    batch_id = st.selectbox("Batch", batches, format_func=lambda batch: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(batch_created[batch])))
+    batch_jobs = [job for job in user_jobs if job["batch_id"] == batch_id]
+    active_jobs = [job for job in batch_jobs if job["status"] in ACTIVE_STATUSES]
+
+    finished = len(batch_jobs) - len(active_jobs)
+    running = sum(job["progress"] for job in active_jobs)
+    st.progress(min(1.0, (finished + running) / len(batch_jobs)))
+    st.table({"File": [os.path.basename(job["input"]) for job in batch_jobs],
+              "Status": [job["status"] for job in batch_jobs],
+              "Progress (%)": [round(job["progress"] * 100) for job in batch_jobs],
+              "Queued (s)": [round((job["started"] or time.time()) - job["created"], 1) for job in batch_jobs],
+              "Run (s)": [round((job["finished"] or time.time()) - job["started"], 1) if job["started"] else "-" for job in batch_jobs]})
+    if job_queue.active(current_user):
+        st.button("Cancel My Jobs", on_click=job_queue.cancel, args=(current_user,))
+
+    output_files = []
+    size_data = []
+    video_results = []
+    for job in batch_jobs:
+        result = job["result"]
+        if job["status"] == "failed":
+            label = "Error compressing image" if job["kind"] == "image" else "FFmpeg Error"
+            st.error(f"{label}: {os.path.basename(job['input'])}")
+        if job["status"] != "done":
+            continue
+        before_size, after_size = result["before_size"], result["after_size"]
+        saved_seconds = result.get("saved_seconds")
+        if result.get("duplicate_of"):
+            note = f"copy of {os.path.basename(result['duplicate_of'])}"
+        elif job["kind"] == "image":
+            note = "cached" if result["cached"] else f"{result['quality']} ({result['attempts']} encodes)"
+            if result.get("saved_vs_jpeg") is not None:
+                note += f", {result['format']} ({-result['saved_vs_jpeg']:+.0%} vs JPEG)"
+        else:
+            note = "skipped (copied through)" if result["skipped"] else "-"
+            video_results.append(result)
+        if before_size and after_size:
+            size_data.append([os.path.basename(job["input"]), before_size, after_size, round((before_size - after_size) / before_size * 100, 2), round(result["ssim"], 4) if result.get("ssim") is not None else "-", note, format_stages(result["stages"]), round(saved_seconds, 2) if saved_seconds is not None else "-"])
+            output_files.append(result["output"])
+
+    if video_results and not active_jobs:
+        video_jobs = [job for job in batch_jobs if job["kind"] == "video" and job["started"]]
+        wall_seconds = max(job["finished"] for job in video_jobs) - min(job["started"] for job in video_jobs)
+        summary = throughput_summary(video_results, wall_seconds)
+        st.write(f"Videos: {summary['jobs']} done in {summary['wall_seconds']:.1f}s "
+                 f"({summary['speed']:.2f}x realtime, {summary['mb_per_s']:.2f} MB/s)")
+
+    cache_stats = get_result_cache().stats()
+    st.sidebar.caption(f"Result cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+
+    # Show Size Comparison Table
+    if size_data:
+        st.write("### Before and After Size Comparison:")
+        st.table({"File Name": [row[0] for row in size_data],
+                  "Before Size (KB)": [row[1] for row in size_data],
+                  "After Size (KB)": [row[2] for row in size_data],
+                  "Saved (%)": [row[3] for row in size_data],
+                  "SSIM": [row[4] for row in size_data],
+                  "Details": [row[5] for row in size_data],
+                  "Stages": [row[6] for row in size_data],
+                  "Encode Saved (s)": [row[7] for row in size_data]})
+        reused = [row[7] for row in size_data if row[7] != "-"]
+        if reused:
+            st.write(f"Near-duplicates: {len(reused)} reused, {sum(reused):.1f}s of encoding saved")
+
+    # ZIP and Download (built incrementally in a spooled file)
+    archive = batch_archive(batch_id)
+    for output_file in output_files:
+        if not archive.closed and os.path.exists(output_file):
+            archive.add(output_file)
+    if archive.paths and not active_jobs:
+        # download_button only accepts bytes, BytesIO or real files and buffers the data as bytes either way
+        st.download_button("Download All as ZIP", data=archive.finish().read(), file_name="compressed_files.zip", mime="application/zip")
+
+    # Poll until the batch is finished
+    if active_jobs:
+        time.sleep(POLL_SECONDS)
+        st.rerun()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import zipfile
+
+# Archives stay in memory up to this size, then spill to a temporary file
+SPOOL_BYTES = 64 * 1024 ** 2
+
+# Already-compressed media gains nothing from deflate, so it is stored as is
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".avif", ".mp4", ".avi", ".mkv", ".mov", ".zip"}
+
+
+class StreamingZip:
+    """
+    ZIP archive built one file at a time as results finish, instead of all
+    at once at the end. Media entries are stored rather than deflated, and
+    the archive is spooled to disk once it outgrows SPOOL_BYTES.
+    """
+
+    def __init__(self, spool_bytes=SPOOL_BYTES, spool_dir=None):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes, dir=spool_dir)
+        self._zip = zipfile.ZipFile(self.file, "w", allowZip64=True)
+        self.paths = set()
+        self.closed = False
+
+    def add(self, path, arcname=None):
+        """
+        Append a file unless it is already in the archive. Returns True if added.
+        """
+        if path in self.paths:
+            return False
+        ext = os.path.splitext(path)[1].lower()
+        compression = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        self._zip.write(path, arcname or os.path.basename(path), compress_type=compression)
+        self.paths.add(path)
+        return True
+
+    def finish(self):
+        """
+        Write the central directory and rewind. Returns the archive file object,
+        ready to be read or served without copying it into a bytes object.
+        """
+        if not self.closed:
+            self._zip.close()
+            self.closed = True
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        if not self.closed:
+            self._zip.close()
+            self.closed = True
+        self.file.close()
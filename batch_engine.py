@@ -0,0 +1,195 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from io import BytesIO
+from PIL import Image
+import logging
+import os
+import time
+
+from dedup import find_duplicates, reuse_output
+from image_compressor import (compress_image, image_cache_params, cached_output, get_engine, is_path, source_name,
+                              source_size)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cap on decoded megapixels held by all workers at once (~1.2 GB of RGB)
+DEFAULT_MAX_MEGAPIXELS = 400
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def image_megapixels(source):
+    """
+    Read the pixel count of an image (path, bytes or file-like) from its
+    header without decoding it.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    try:
+        with Image.open(source) as img:
+            return img.width * img.height / 1_000_000
+    except Exception:
+        return 0.0
+    finally:
+        if not is_path(source):
+            source.seek(0)
+
+
+def init_worker():
+    """
+    Process pool initializer: metrics events travel back with each result
+    and are recorded by the parent.
+    """
+    metrics.REGISTRY.forward_events()
+
+
+def compress_job(input_path, output_path, options):
+    """
+    Compress one image in a worker process. Returns a result dict as yielded
+    by compress_images, plus the worker's metrics events under "events".
+    """
+    before_size = source_size(input_path) // 1024
+    stats = compress_image(input_path, output_path, **options)
+    # Auto format may change the output extension
+    output_path = stats["output"] if stats else output_path
+    after_size = os.path.getsize(output_path) // 1024 if stats else None
+    result = {"input": source_name(input_path), "output": output_path, "ok": bool(stats),
+              "before_size": before_size, "after_size": after_size, "cached": False, "stages": {}}
+    if stats:
+        result.update(stats)
+    result["events"] = metrics.REGISTRY.drain()
+    return result
+
+
+def duplicate_results(result, members):
+    """
+    Reuse a representative's result for the near-duplicates it stands for.
+    Args:
+        result: The representative's result dict.
+        members: (input, output_path) pairs of its duplicates.
+    Yields:
+        A result dict per member, with duplicate_of and saved_seconds.
+    """
+    saved_seconds = sum(result.get("stages", {}).values())
+    for src, dst in members:
+        name, bytes_in = source_name(src), source_size(src)
+        try:
+            output_path = reuse_output(result["output"], dst)
+        except OSError as e:
+            logger.error("Error reusing %s for %s: %s", result["output"], name, e)
+            metrics.REGISTRY.record("image", name, "failed", bytes_in, error=e)
+            yield {"input": name, "output": dst, "ok": False, "cached": False, "stages": {},
+                   "before_size": bytes_in // 1024, "after_size": None}
+            continue
+        bytes_out = os.path.getsize(output_path)
+        metrics.REGISTRY.record("image", name, "deduplicated", bytes_in, bytes_out)
+        yield {"input": name, "output": output_path, "ok": True, "cached": False, "stages": {},
+               "format": result.get("format"), "quality": result.get("quality"), "ssim": result.get("ssim"),
+               "before_size": bytes_in // 1024, "after_size": bytes_out // 1024,
+               "duplicate_of": result["input"], "saved_seconds": saved_seconds}
+
+
+def compress_images(jobs, workers=None, max_megapixels=DEFAULT_MAX_MEGAPIXELS, cache=None, dedup_distance=None,
+                    **options):
+    """
+    Compress images over a worker process pool, yielding results as they finish.
+    Args:
+        jobs: Iterable of (input_path, output_path) pairs.
+        workers: Number of worker processes (defaults to the CPU count).
+        max_megapixels: Cap on decoded megapixels in flight at once. An image
+            larger than the cap still runs, but on its own.
+        cache: Optional ResultCache, consulted before any job is submitted.
+            Hits are yielded first, without touching the pool.
+        dedup_distance: If set, images whose perceptual hashes are within
+            this Hamming distance are clustered (see dedup.find_duplicates)
+            and only the largest of each cluster is compressed; the others
+            get a copy of its output. If a representative
+            fails, its duplicates are compressed on their own.
+        **options: Keyword arguments passed to compress_image. With min_ssim,
+            each job's search starts from the quality of the most recently
+            finished image, since a batch tends to share similar content.
+    Yields:
+        A dict per image with input, output, ok, cached, before_size and
+        after_size (KB), plus compress_image's quality, attempts, SSIM
+        score and per-stage seconds, in completion order. Deduplicated images
+        add duplicate_of (the representative's input) and saved_seconds (the
+        representative's processing time). Worker metrics events are
+        replayed into this process's metrics.REGISTRY.
+    """
+    jobs = list(jobs)
+    duplicates = {}
+    if dedup_distance is not None and len(jobs) > 1:
+        started = time.perf_counter()
+        clusters = find_duplicates([src for src, _ in jobs], dedup_distance, workers)
+        duplicates = {jobs[i][0]: [jobs[j] for j in members] for i, members in clusters.items()}
+        skipped = {j for members in clusters.values() for j in members}
+        jobs = [job for i, job in enumerate(jobs) if i not in skipped]
+        logger.info("Dedup: %d near-duplicates reuse %d representatives (hashing took %.2fs)", len(skipped),
+                    len(clusters), time.perf_counter() - started)
+
+    pending = []
+    for src, dst in jobs:
+        key = None
+        if cache is not None:
+            key = cache.key(src, image_cache_params(**options))
+            hit_path = cached_output(cache, key, dst, options.get("output_format", "JPEG"))
+            if hit_path:
+                bytes_in, bytes_out = os.path.getsize(src), os.path.getsize(hit_path)
+                metrics.REGISTRY.record("image", src, "cached", bytes_in, bytes_out)
+                result = {"input": src, "output": hit_path, "ok": True, "cached": True, "stages": {},
+                          "format": cache.meta(key).get("format"), "ssim": cache.meta(key).get("ssim"),
+                          "before_size": bytes_in // 1024, "after_size": bytes_out // 1024}
+                yield result
+                yield from duplicate_results(result, duplicates.pop(src, []))
+                continue
+        pending.append((src, dst, key, image_megapixels(src)))
+    if not pending:
+        return
+    pending.reverse()
+    workers = max(1, min(workers or default_workers(), len(pending) or 1))
+    last_quality = None
+    # Pick the image engine here, so the workers inherit it rather than each benchmarking
+    get_engine()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        running = {}
+        in_flight_mp = 0.0
+        while pending or running:
+            # Admit jobs while there is a free worker and megapixel budget left
+            while pending and len(running) < workers:
+                src, dst, key, mp = pending[-1]
+                if running and in_flight_mp + mp > max_megapixels:
+                    break
+                pending.pop()
+                job_options = options
+                if options.get("min_ssim") and last_quality:
+                    job_options = dict(options, start_quality=last_quality)
+                future = pool.submit(compress_job, src, dst, job_options)
+                running[future] = (src, dst, key, mp)
+                in_flight_mp += mp
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                src, dst, key, mp = running.pop(future)
+                in_flight_mp -= mp
+                try:
+                    result = future.result()
+                    metrics.REGISTRY.replay(result.pop("events"))
+                except Exception as e:
+                    logger.error("Error compressing image %s: %s", src, e)
+                    metrics.REGISTRY.record("image", src, "failed", error=e)
+                    result = {"input": src, "output": dst, "ok": False, "cached": False, "stages": {},
+                              "before_size": None, "after_size": None}
+                if result.get("ssim") is not None:
+                    last_quality = result["quality"]
+                if result["ok"] and key:
+                    cache.put(key, result["output"], {"format": result["format"], "ssim": result.get("ssim")})
+                yield result
+                members = duplicates.pop(src, [])
+                if result["ok"]:
+                    yield from duplicate_results(result, members)
+                else:
+                    pending.extend((member_src, member_dst, None, image_megapixels(member_src))
+                                   for member_src, member_dst in members)
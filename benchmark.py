@@ -0,0 +1,247 @@
+"""
+Reproducible compression benchmark.
+
+    python benchmark.py generate --corpus bench_corpus --seed 0
+    python benchmark.py run --corpus bench_corpus --output results.json
+    python benchmark.py run --corpus bench_corpus --output new.json --baseline results.json
+    python benchmark.py run --image-options '{"output_format": "WEBP"}' --video-options '{"crf": 28}'
+    python benchmark.py engines
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from dummy_video_creator import create_dummy_video
+from image_compressor import available_engines, benchmark_engines, check_conformance, compress_image, get_engine
+from video_compressor import compress_video
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+IMAGE_SIZES = [(640, 480), (1920, 1080), (4000, 3000)]
+IMAGE_PATTERNS = ["photo", "screenshot", "noise"]
+VIDEO_SIZES = [(640, 480), (1280, 720)]
+VIDEO_DURATIONS = [2, 6]
+VIDEO_PATTERNS = ["motion", "noise"]
+VIDEO_FPS = 24
+MANIFEST_NAME = "corpus.json"
+
+
+def photo_image(rng, width, height):
+    """
+    Smooth multi-frequency gradients with mild sensor-like noise.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for _ in range(3):
+        fx, fy, phase = rng.uniform(1, 6), rng.uniform(1, 6), rng.uniform(0, np.pi)
+        channel = 128 + 90 * np.sin(x / width * fx + phase) * np.cos(y / height * fy)
+        channels.append(channel + rng.normal(0, 4, (height, width)))
+    return Image.fromarray(np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8))
+
+
+def screenshot_image(rng, width, height):
+    """
+    Flat window panels with lines of text, like a desktop screenshot.
+    """
+    img = Image.new("RGB", (width, height), (245, 245, 245))
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        x0, y0 = int(rng.integers(0, width * 3 // 4)), int(rng.integers(0, height * 3 // 4))
+        x1, y1 = x0 + int(rng.integers(width // 8, width // 3)), y0 + int(rng.integers(height // 8, height // 3))
+        draw.rectangle((x0, y0, x1, y1), fill=tuple(int(c) for c in rng.integers(180, 256, 3)), outline=(90, 90, 90))
+        for line_y in range(y0 + 8, y1 - 12, 14):
+            draw.text((x0 + 8, line_y), "Lorem ipsum dolor sit amet 0123456789", fill=(20, 20, 20))
+    return img
+
+
+def noise_image(rng, width, height):
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def generate_corpus(corpus_dir, seed=0):
+    """
+    Write the deterministic image and video corpus plus its manifest.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    entries = []
+    makers = {"photo": photo_image, "screenshot": screenshot_image, "noise": noise_image}
+    for pattern in IMAGE_PATTERNS:
+        for width, height in IMAGE_SIZES:
+            # Photos ship as JPEG, everything else as PNG, like real uploads
+            ext = "jpg" if pattern == "photo" else "png"
+            name = f"image_{pattern}_{width}x{height}.{ext}"
+            img = makers[pattern](rng, width, height)
+            if ext == "jpg":
+                img.save(os.path.join(corpus_dir, name), "JPEG", quality=95)
+            else:
+                img.save(os.path.join(corpus_dir, name), "PNG")
+            entries.append({"file": name, "kind": "image", "pattern": pattern, "width": width, "height": height})
+    for pattern in VIDEO_PATTERNS:
+        for width, height in VIDEO_SIZES:
+            for duration in VIDEO_DURATIONS:
+                name = f"video_{pattern}_{width}x{height}_{duration}s.mp4"
+                frames = create_dummy_video(os.path.join(corpus_dir, name), width, height, VIDEO_FPS, duration,
+                                            pattern=pattern, seed=int(rng.integers(0, 2 ** 31)), codec="mp4v")
+                entries.append({"file": name, "kind": "video", "pattern": pattern, "width": width,
+                                "height": height, "duration": duration, "frames": frames})
+    with open(os.path.join(corpus_dir, MANIFEST_NAME), "w") as file:
+        json.dump({"seed": seed, "files": entries}, file, indent=2)
+    return entries
+
+
+def _peak_rss_mb(who):
+    if who == "self" and os.path.exists("/proc/self/status"):
+        # ru_maxrss is inherited across fork and exec, so a spawned child would
+        # report the parent's peak; VmHWM starts afresh with the new process
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _measure(entry, input_path, output_path, options):
+    # Runs in a fresh process per file so the RSS high-water mark is per file.
+    # Returns the actual output path, since auto format and pre-flight skips
+    # change its extension.
+    start = time.perf_counter()
+    if entry["kind"] == "image":
+        stats = compress_image(input_path, output_path, **options)
+        peak = _peak_rss_mb("self")
+    else:
+        stats = compress_video(input_path, output_path, **options)
+        peak = _peak_rss_mb("children")
+    return stats["output"] if stats else None, time.perf_counter() - start, peak
+
+
+def run_benchmark(corpus_dir, output_dir=None, image_options=None, video_options=None):
+    """
+    Compress every corpus file and measure latency, throughput, peak RSS
+    and compression ratio.
+    """
+    with open(os.path.join(corpus_dir, MANIFEST_NAME)) as file:
+        manifest = json.load(file)
+    output_dir = output_dir or os.path.join(corpus_dir, "out")
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    # Pick the image engine here: get_engine exports the choice through the
+    # environment, so the per-file processes skip the conformance check and
+    # self-benchmark instead of timing them
+    engine = get_engine()
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for entry in manifest["files"]:
+            input_path = os.path.join(corpus_dir, entry["file"])
+            ext = ".jpg" if entry["kind"] == "image" else ".mp4"
+            output_path = os.path.join(output_dir, os.path.splitext(entry["file"])[0] + ext)
+            options = (image_options if entry["kind"] == "image" else video_options) or {}
+            # Never measure a file left over from an earlier run
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            output_path, latency, peak = pool.apply(_measure, (entry, input_path, output_path, options))
+
+            ok = output_path is not None
+            before = os.path.getsize(input_path)
+            after = os.path.getsize(output_path) if ok else None
+            result = {"file": entry["file"], "kind": entry["kind"], "ok": ok, "latency_s": latency,
+                      "peak_rss_mb": peak, "bytes_in": before, "bytes_out": after,
+                      "ratio": before / after if after else None}
+            if entry["kind"] == "image":
+                result["mp_per_s"] = entry["width"] * entry["height"] / 1e6 / latency
+            else:
+                result["frames_per_s"] = entry["frames"] / latency
+            results.append(result)
+            print(f"{entry['file']}: {latency:.3f}s, ratio {result['ratio'] or 0:.2f}")
+
+    return {"meta": {"seed": manifest["seed"], "time": time.time(), "python": platform.python_version(),
+                     "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                     "image_engine": engine.name, "image_options": image_options or {},
+                     "video_options": video_options or {}},
+            "results": results}
+
+
+def compare(current, baseline, threshold=0.10):
+    """
+    Compare a run against a baseline. Returns per-file changes and the list of
+    files whose latency grew or compression ratio shrank by more than threshold.
+    """
+    base = {r["file"]: r for r in baseline["results"]}
+    changes, regressions = [], []
+    for result in current["results"]:
+        old = base.get(result["file"])
+        if not old or not (old["ok"] and result["ok"]):
+            continue
+        latency_change = result["latency_s"] / old["latency_s"] - 1
+        ratio_change = result["ratio"] / old["ratio"] - 1
+        changes.append({"file": result["file"], "latency_change": latency_change, "ratio_change": ratio_change})
+        if latency_change > threshold or ratio_change < -threshold:
+            regressions.append(result["file"])
+    return {"changes": changes, "regressions": regressions}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Image and video compression benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="Generate the synthetic corpus")
+    generate.add_argument("--corpus", default="bench_corpus")
+    generate.add_argument("--seed", type=int, default=0)
+    run = commands.add_parser("run", help="Benchmark the corpus")
+    run.add_argument("--corpus", default="bench_corpus")
+    run.add_argument("--output", default="bench_results.json")
+    run.add_argument("--baseline", help="Saved results to compare against")
+    run.add_argument("--threshold", type=float, default=0.10, help="Regression threshold (fraction)")
+    run.add_argument("--image-options", type=json.loads, default=None,
+                     help="JSON object of compress_image keyword arguments, e.g. '{\"quality\": 60}'")
+    run.add_argument("--video-options", type=json.loads, default=None,
+                     help="JSON object of compress_video keyword arguments, e.g. '{\"crf\": 28}'")
+    commands.add_parser("engines", help="Check and time the available image engines")
+    args = parser.parse_args(argv)
+
+    if args.command == "engines":
+        engines = available_engines()
+        failures = [failure for engine in engines.values() for failure in check_conformance(engine)]
+        for name, seconds in benchmark_engines(engines).items():
+            print(f"{name}: {seconds * 1000:.0f} ms")
+        for failure in failures:
+            print(f"FAIL {failure}")
+        return 1 if failures else 0
+
+    if args.command == "generate":
+        entries = generate_corpus(args.corpus, args.seed)
+        print(f"Generated {len(entries)} files in {args.corpus}")
+        return 0
+
+    report = run_benchmark(args.corpus, image_options=args.image_options, video_options=args.video_options)
+    if args.baseline:
+        with open(args.baseline) as file:
+            report["comparison"] = compare(report, json.load(file), args.threshold)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        for change in report["comparison"]["changes"]:
+            print(f"{change['file']}: latency {change['latency_change']:+.1%}, ratio {change['ratio_change']:+.1%}")
+        if report["comparison"]["regressions"]:
+            print("Regressions:", ", ".join(report["comparison"]["regressions"]))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""
+Headless compression of whole directory trees.
+
+    python cli.py photos/ compressed/ --quality 80 --format auto
+    python cli.py uploads/ compressed/ --watch --interval 10
+
+The output tree mirrors the input tree. A manifest in the output folder
+records every processed file, so re-runs (and runs resumed after an
+interruption) only compress new or changed files.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from batch_engine import compress_images, default_workers
+from dedup import DEFAULT_MAX_DISTANCE
+from image_compressor import ENGINE_ENV, image_cache_params, with_format_extension
+from manifest import Manifest
+from result_cache import ResultCache
+from video_compressor import video_cache_params
+from video_scheduler import compress_videos, default_thread_budget
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mkv"}
+MANIFEST_NAME = ".compress_manifest.jsonl"
+
+# Files modified more recently than this are assumed to still be copying in
+DEFAULT_SETTLE_SECONDS = 2.0
+
+
+def scan_tree(source_dir, exclude_dir=None):
+    """
+    Relative paths of the images and videos under source_dir, skipping
+    exclude_dir (the output tree, when it sits inside the source).
+    """
+    exclude_dir = os.path.abspath(exclude_dir) if exclude_dir else None
+    images, videos = [], []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != exclude_dir)
+        for name in sorted(files):
+            ext = os.path.splitext(name)[1].lower()
+            rel_path = os.path.relpath(os.path.join(root, name), source_dir)
+            if ext in IMAGE_EXTENSIONS:
+                images.append(rel_path)
+            elif ext in VIDEO_EXTENSIONS:
+                videos.append(rel_path)
+    return images, videos
+
+
+def output_path_for(rel_path, output_dir, kind, image_format="JPEG"):
+    """
+    Mirror rel_path under output_dir with the extension of the output format.
+    """
+    path = os.path.join(output_dir, rel_path)
+    if kind == "image":
+        return with_format_extension(path, "JPEG" if image_format.upper() == "AUTO" else image_format)
+    return os.path.splitext(path)[0] + ".mp4"
+
+
+def output_paths(rel_paths, output_dir, kind, image_format="JPEG"):
+    """
+    Output path for each of rel_paths (see output_path_for). Sources that
+    would share an output, such as logo.jpg and logo.png, keep their own
+    extension in the stem instead (logo.jpg.jpg, logo.png.jpg).
+    """
+    paths = {rel_path: output_path_for(rel_path, output_dir, kind, image_format) for rel_path in rel_paths}
+    claims = {}
+    for rel_path, path in paths.items():
+        # Case-insensitive, as on Windows and macOS file systems
+        claims.setdefault(os.path.normcase(path).lower(), []).append(rel_path)
+    for rel_paths in claims.values():
+        if len(rel_paths) > 1:
+            for rel_path in rel_paths:
+                path = paths[rel_path]
+                paths[rel_path] = os.path.join(os.path.dirname(path), os.path.basename(rel_path) +
+                                               os.path.splitext(path)[1])
+    return paths
+
+
+def _same_output(previous, path):
+    # Extensions may differ (auto format, pre-flight copies); the stem decides
+    return os.path.splitext(os.path.abspath(previous))[0] == os.path.splitext(os.path.abspath(path))[0]
+
+
+def _manifest_result(result):
+    keys = ("ok", "output", "cached", "skipped", "format", "quality", "ssim", "before_size", "after_size",
+            "duplicate_of")
+    return {key: result.get(key) for key in keys}
+
+
+def run_once(source_dir, output_dir, manifest, image_options, video_options, workers=None, threads=None,
+             cache=None, settle_seconds=0.0, retry_failed=False, dedup_distance=None):
+    """
+    Compress every new or changed file under source_dir into output_dir.
+    Each finished file is written to the manifest straight away. With
+    dedup_distance, near-duplicate images among the pending ones are
+    compressed once (see batch_engine.compress_images).
+    Returns:
+        A dict with the number of files compressed, failed and skipped as
+        unchanged.
+    """
+    images, videos = scan_tree(source_dir, exclude_dir=output_dir)
+    image_params = image_cache_params(**image_options)
+    video_params = dict(video_cache_params(video_options.get("crf", 23), video_options.get("resolution"),
+                                           video_options.get("bitrate")),
+                        preflight=video_options.get("preflight", False),
+                        min_savings=video_options.get("min_savings"))
+    counts = {"compressed": 0, "failed": 0, "unchanged": 0}
+    now = time.time()
+
+    def pending(paths, kind, params):
+        jobs = {}
+        outputs = output_paths(paths, output_dir, kind, image_options.get("output_format", "JPEG"))
+        for rel_path in paths:
+            input_path = os.path.join(source_dir, rel_path)
+            output_path = outputs[rel_path]
+            try:
+                if now - os.path.getmtime(input_path) < settle_seconds:
+                    continue
+                if not manifest.needs_processing(rel_path, input_path, params, retry_failed):
+                    previous = manifest.entries[rel_path]["result"].get("output")
+                    # Re-run files whose output was renamed by a new name collision
+                    if not previous or _same_output(previous, output_path):
+                        counts["unchanged"] += 1
+                        continue
+            except OSError:
+                # Removed or renamed since the scan
+                continue
+            if output_path != output_path_for(rel_path, output_dir, kind, image_options.get("output_format", "JPEG")):
+                logger.warning("%s shares an output name with another file; writing %s", rel_path, output_path)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            jobs[input_path] = (rel_path, output_path)
+        return jobs
+
+    def finish(result, jobs, params):
+        rel_path = jobs[result["input"]][0]
+        manifest.record(rel_path, result["input"], params, _manifest_result(result))
+        if result["ok"]:
+            counts["compressed"] += 1
+            logger.info("%s -> %s (%s KB -> %s KB)", rel_path, result["output"], result["before_size"],
+                        result["after_size"])
+        else:
+            counts["failed"] += 1
+            logger.error("Failed: %s", rel_path)
+
+    image_jobs = pending(images, "image", image_params)
+    if image_jobs:
+        for result in compress_images([(src, dst) for src, (_, dst) in image_jobs.items()], workers=workers,
+                                      cache=cache, dedup_distance=dedup_distance, **image_options):
+            finish(result, image_jobs, image_params)
+
+    video_jobs = pending(videos, "video", video_params)
+    if video_jobs:
+        for result in compress_videos([(src, dst) for src, (_, dst) in video_jobs.items()],
+                                      total_threads=threads, cache=cache, **video_options):
+            if not result["cancelled"]:
+                finish(result, video_jobs, video_params)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compress the images and videos in a directory tree")
+    parser.add_argument("source", help="Input directory")
+    parser.add_argument("output", help="Output directory (mirrors the input tree)")
+    parser.add_argument("--manifest", help=f"Manifest path (default: <output>/{MANIFEST_NAME})")
+    parser.add_argument("--watch", action="store_true", help="Keep polling the input for new files")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between polls in watch mode")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="Skip files modified less than this many seconds ago (watch mode)")
+    parser.add_argument("--retry-failed", action="store_true", help="Retry files that failed in earlier runs")
+    parser.add_argument("--workers", type=int, default=default_workers(), help="Image worker processes")
+    parser.add_argument("--threads", type=int, default=default_thread_budget(), help="Video thread budget")
+    parser.add_argument("--cache-dir", help="Result cache directory (disabled if not given)")
+    parser.add_argument("--quality", type=int, default=75)
+    parser.add_argument("--no-resize", action="store_true", help="Keep the original image resolution")
+    parser.add_argument("--width", type=int)
+    parser.add_argument("--height", type=int)
+    parser.add_argument("--exact", action="store_true", help="Exact LANCZOS resize (slower)")
+    parser.add_argument("--target-kb", type=int, help="Target image size in KB")
+    parser.add_argument("--min-ssim", type=float, help="Minimum SSIM instead of a fixed quality")
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "WEBP", "AVIF", "auto"])
+    parser.add_argument("--engine", choices=["pillow", "vips"],
+                        help="Image engine (default: vips if installed and conforming, else pillow)")
+    parser.add_argument("--dedup", type=int, nargs="?", const=DEFAULT_MAX_DISTANCE, metavar="DISTANCE",
+                        help=f"Compress near-duplicate images once (perceptual hash distance, "
+                             f"default {DEFAULT_MAX_DISTANCE})")
+    parser.add_argument("--crf", type=int, default=23)
+    parser.add_argument("--resolution", help="Video output size such as 1280x720")
+    parser.add_argument("--bitrate", help="Video bitrate such as 1000k")
+    parser.add_argument("--preflight", action="store_true", help="Copy through videos that won't shrink")
+    parser.add_argument("--min-savings", type=float, default=0.10)
+    parser.add_argument("--segmented", action="store_true", help="Segmented encoding for long videos")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.engine:
+        os.environ[ENGINE_ENV] = args.engine
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output, MANIFEST_NAME))
+    cache = ResultCache(args.cache_dir) if args.cache_dir else None
+    image_options = {"quality": args.quality, "resize": not args.no_resize, "width": args.width,
+                     "height": args.height, "exact": args.exact,
+                     "target_bytes": args.target_kb * 1024 if args.target_kb else None,
+                     "output_format": args.format, "min_ssim": args.min_ssim}
+    video_options = {"crf": args.crf, "resolution": args.resolution, "bitrate": args.bitrate,
+                     "preflight": args.preflight, "min_savings": args.min_savings, "segmented": args.segmented}
+
+    def run(settle_seconds):
+        return run_once(args.source, args.output, manifest, image_options, video_options, args.workers,
+                        args.threads, cache, settle_seconds, args.retry_failed, args.dedup)
+
+    if not args.watch:
+        counts = run(0.0)
+        manifest.compact()
+        logger.info("%d compressed, %d failed, %d unchanged", counts["compressed"], counts["failed"],
+                    counts["unchanged"])
+        return 1 if counts["failed"] else 0
+
+    logger.info("Watching %s every %.0fs (Ctrl+C to stop)", args.source, args.interval)
+    try:
+        while True:
+            counts = run(args.settle)
+            if counts["compressed"] or counts["failed"]:
+                logger.info("%d compressed, %d failed", counts["compressed"], counts["failed"])
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped")
+    finally:
+        manifest.compact()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
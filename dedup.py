@@ -0,0 +1,152 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+import logging
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+from image_compressor import LARGE_IMAGE_PIXELS, is_path, open_image, source_name
+
+logger = logging.getLogger(__name__)
+
+# Hashes are HASH_SIZE x HASH_SIZE bits from the low frequencies of a
+# THUMBNAIL_SIZE greyscale thumbnail's DCT
+HASH_SIZE = 8
+THUMBNAIL_SIZE = 32
+
+# Default Hamming distance (out of 64 bits) for two images to count as copies
+DEFAULT_MAX_DISTANCE = 6
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(THUMBNAIL_SIZE)
+
+
+@contextmanager
+def _opened(source):
+    # Open a path, bytes or file-like object, leaving file-likes rewound for the encoder
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    elif not is_path(source):
+        source.seek(0)
+    try:
+        with open_image(source) as img:
+            yield img
+    finally:
+        if not is_path(source):
+            source.seek(0)
+
+
+def perceptual_hash(source):
+    """
+    64-bit perceptual hash of an image (path, bytes or file-like): the signs
+    of the low-frequency DCT coefficients of a greyscale thumbnail relative
+    to their median. Re-exports, resized copies and light edits land within
+    a few bits of each other. Returns None for unreadable or very large
+    images, which are then never treated as duplicates.
+    """
+    try:
+        with _opened(source) as img:
+            if img.width * img.height > LARGE_IMAGE_PIXELS:
+                return None
+            # JPEGs decode straight at 1/8 scale
+            img.draft("L", (THUMBNAIL_SIZE * 4, THUMBNAIL_SIZE * 4))
+            thumb = img.convert("L").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BOX)
+    except Exception as e:
+        logger.warning("Cannot hash %s: %s", source_name(source), e)
+        return None
+    pixels = np.asarray(thumb, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+# Set bits per byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(hashes, others):
+    """
+    Hamming distances between two lists of 64-bit hashes as a
+    len(hashes) x len(others) matrix.
+    """
+    xor = np.array(hashes, dtype=np.uint64)[:, None] ^ np.array(others, dtype=np.uint64)[None, :]
+    return _POPCOUNT[xor.view(np.uint8)].reshape(xor.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def cluster(hashes, max_distance=DEFAULT_MAX_DISTANCE, order=None):
+    """
+    Leader clustering: taking indices in `order` (default: index order),
+    each hash joins the nearest cluster leader within max_distance or
+    leads a new cluster. Every member is within max_distance of its
+    leader, never merely of another member. None hashes stay in their own
+    group.
+    Returns:
+        A list of index lists, one per cluster, leader first.
+    """
+    groups = []
+    leader_groups = []
+    leaders = np.empty(len(hashes), dtype=np.uint64)
+    for i in range(len(hashes)) if order is None else order:
+        if hashes[i] is None:
+            groups.append([i])
+            continue
+        if leader_groups:
+            distances = hamming_distances([hashes[i]], leaders[:len(leader_groups)])[0]
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= max_distance:
+                leader_groups[nearest].append(i)
+                continue
+        leaders[len(leader_groups)] = hashes[i]
+        leader_groups.append([i])
+        groups.append(leader_groups[-1])
+    return groups
+
+
+def _pixels(source):
+    try:
+        with _opened(source) as img:
+            return img.width * img.height
+    except Exception:
+        return 0
+
+
+def find_duplicates(sources, max_distance=DEFAULT_MAX_DISTANCE, workers=None):
+    """
+    Hash all sources and cluster near-duplicates. Larger images (by pixel
+    count) lead clusters first, so each representative is the largest
+    image of its cluster and within max_distance of all its duplicates.
+    Returns:
+        {representative index: [duplicate indices]} for clusters with
+        more than one member.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = list(pool.map(perceptual_hash, sources))
+        pixels = list(pool.map(_pixels, sources))
+    order = sorted(range(len(sources)), key=lambda i: -pixels[i])
+    duplicates = {}
+    for group in cluster(hashes, max_distance, order):
+        if len(group) > 1:
+            duplicates[group[0]] = group[1:]
+    return duplicates
+
+
+def reuse_output(representative_output, output_path):
+    """
+    Copy a representative's output for a duplicate, keeping the
+    representative's extension. Returns the path. (A copy rather than a hard
+    link, since outputs are rewritten in place on later runs.)
+    """
+    output_path = os.path.splitext(output_path)[0] + os.path.splitext(representative_output)[1]
+    if os.path.abspath(output_path) != os.path.abspath(representative_output):
+        shutil.copyfile(representative_output, output_path)
+    return output_path
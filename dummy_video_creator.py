@@ -1,21 +1,49 @@
 import cv2
 import numpy as np
 
-def create_dummy_video(output_path, width=640, height=480, fps=24, duration=5):
+def create_dummy_video(output_path, width=640, height=480, fps=24, duration=5, pattern="noise", seed=None,
+                       codec="XVID"):
     """
     Simple video file banane ka code.
+    pattern: "noise" for random frames (worst case for every codec), or
+        "motion" for shapes moving over a gradient (closer to real footage).
+    seed: Same seed, same frames - for reproducible benchmarks.
+    codec: FourCC of the OpenCV writer, e.g. "XVID" for .avi or "mp4v" for .mp4.
+    Returns the number of frames written.
     """
-    fourcc = cv2.VideoWriter_fourcc(*'XVID')  # Codec
+    fourcc = cv2.VideoWriter_fourcc(*codec)  # Codec
     out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
     total_frames = fps * duration
+    rng = np.random.default_rng(seed)
 
-    for _ in range(total_frames):
-        # Random color ke frames banata hai
-        frame = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    if pattern == "motion":
+        # Background gradient ek baar banao, har frame pe shapes move karo
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        background = np.stack([np.broadcast_to(x, (height, width)),
+                               np.broadcast_to(y, (height, width)),
+                               np.full((height, width), 96, np.float32)], axis=-1).astype(np.uint8)
+        size = max(8, min(width, height) // 6)
+        colors = [tuple(int(c) for c in rng.integers(0, 256, 3)) for _ in range(2)]
+
+    for i in range(total_frames):
+        if pattern == "motion":
+            frame = background.copy()
+            t = i / max(1, total_frames - 1)
+            x0 = int(t * (width - size))
+            y0 = int((0.5 + 0.4 * np.sin(t * 2 * np.pi)) * (height - size))
+            cv2.rectangle(frame, (x0, y0), (x0 + size, y0 + size), colors[0], -1)
+            cx = int((1 - t) * (width - size) + size // 2)
+            cv2.circle(frame, (cx, height // 2), size // 2, colors[1], -1)
+        else:
+            # Random color ke frames banata hai
+            frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
         out.write(frame)
 
     out.release()
     print(f"Dummy video created successfully at {output_path}")
+    return total_frames
 
-# Example Call
-create_dummy_video("dummy_video.avi", duration=5)
+if __name__ == "__main__":
+    # Example Call
+    create_dummy_video("dummy_video.avi", duration=5)
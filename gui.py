@@ -1,37 +1,125 @@
 import sys
 import os
+import logging
+import threading
+import time
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QFileDialog,
-    QLabel, QProgressBar, QTableWidget, QTableWidgetItem, QComboBox, QSlider, QCheckBox
+    QLabel, QProgressBar, QTableWidget, QTableWidgetItem, QComboBox, QSlider, QCheckBox,
+    QSpinBox, QDoubleSpinBox
 )
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
-from image_compressor import compress_image
+from image_compressor import compress_image, output_name, AVIF_AVAILABLE, FORMAT_EXTENSIONS
 from video_compressor import compress_video
+from batch_engine import compress_images, default_workers
+from dedup import DEFAULT_MAX_DISTANCE
+from video_scheduler import compress_videos, throughput_summary
+from result_cache import ResultCache
+from metrics import format_stages
+
+logger = logging.getLogger(__name__)
+
+
+def format_score(score):
+    return f"{score:.4f}" if score is not None else "-"
 
 
 class CompressionThread(QThread):
-    progress_signal = pyqtSignal(int, str, int, int, float)
+    progress_signal = pyqtSignal(int, str, int, int, float, str, str)
+    status_signal = pyqtSignal(str)
+    job_progress_signal = pyqtSignal(dict)
 
-    def __init__(self, files, output_dir, compress_function, quality):
+    def __init__(self, files, output_dir, compress_function, quality, workers=None, image_options=None, cache=None,
+                 cancel_event=None, video_options=None, dedup_distance=None, outputs=None):
         super().__init__()
         self.files = files
         self.output_dir = output_dir
         self.compress_function = compress_function
         self.quality = quality
+        self.workers = workers
+        self.image_options = image_options or {}
+        self.cache = cache
+        self.cancel_event = cancel_event or threading.Event()
+        self.video_options = video_options or {}
+        self.dedup_distance = dedup_distance
+        # Explicit output paths, one per file, for videos saved under a chosen name
+        self.outputs = outputs
 
     def run(self):
+        if self.compress_function is compress_image:
+            self.run_image_batch()
+            return
+        if self.compress_function is compress_video:
+            self.run_video_batch()
+            return
         for i, file in enumerate(self.files):
             output_path = os.path.join(self.output_dir, f"compressed_{os.path.basename(file)}")
             before_size = os.path.getsize(file) // 1024
-            self.compress_function(file, output_path, self.quality)
+            stats = self.compress_function(file, output_path, self.quality, cache=self.cache)
             after_size = os.path.getsize(output_path) // 1024
             saved_percent = ((before_size - after_size) / before_size) * 100 if before_size > 0 else 0
-            self.progress_signal.emit(i + 1, os.path.basename(file), before_size, after_size, saved_percent)
+            stages = format_stages(stats.get("stages")) if stats else "-"
+            self.progress_signal.emit(i + 1, os.path.basename(file), before_size, after_size, saved_percent, stages, "-")
+
+    def run_image_batch(self):
+        # Images fan out over the process pool and report in completion order
+        output_format = self.image_options.get("output_format", "JPEG")
+        jobs = [(file, os.path.join(self.output_dir, output_name(file, output_format))) for file in self.files]
+        results = compress_images(jobs, workers=self.workers, cache=self.cache, dedup_distance=self.dedup_distance,
+                                  quality=self.quality, **self.image_options)
+        duplicates, saved_seconds = 0, 0.0
+        for i, result in enumerate(results):
+            if not result["ok"]:
+                logger.error("Image compression failed: %s", result["input"])
+                continue
+            before_size, after_size = result["before_size"], result["after_size"]
+            saved_percent = ((before_size - after_size) / before_size) * 100 if before_size > 0 else 0
+            stages = format_stages(result["stages"])
+            if result.get("duplicate_of"):
+                duplicates += 1
+                saved_seconds += result["saved_seconds"]
+                stages = f"copy of {os.path.basename(result['duplicate_of'])} (saved {result['saved_seconds']:.2f}s)"
+            self.progress_signal.emit(i + 1, os.path.basename(result["input"]), before_size, after_size, saved_percent,
+                                      stages, format_score(result.get("ssim")))
+        if self.dedup_distance is not None:
+            self.status_signal.emit(f"{duplicates} near-duplicates reused, {saved_seconds:.1f}s of encoding saved")
+
+    def run_video_batch(self):
+        # Several ffmpeg processes share the core budget via per-job -threads
+        outputs = self.outputs or [os.path.join(self.output_dir, f"compressed_{os.path.basename(file)}")
+                                   for file in self.files]
+        jobs = list(zip(self.files, outputs))
+        start = time.perf_counter()
+        results = []
+        videos = compress_videos(jobs, cache=self.cache, crf=23, cancel_event=self.cancel_event,
+                                 progress_callback=self.job_progress_signal.emit, **self.video_options)
+        for i, result in enumerate(videos):
+            results.append(result)
+            name = os.path.basename(result["input"])
+            if result["cancelled"]:
+                continue
+            if not result["ok"]:
+                logger.error("Video compression failed: %s", result["input"])
+                continue
+            if result["skipped"]:
+                logger.info("%s: skipped by pre-flight, copied through", name)
+            logger.info("%s: %d threads, %.2fx realtime, %.2f MB/s", name, result["threads"], result["speed"],
+                        result["mb_per_s"])
+            before_size, after_size = result["before_size"], result["after_size"]
+            saved_percent = ((before_size - after_size) / before_size) * 100 if before_size > 0 else 0
+            self.progress_signal.emit(i + 1, name, before_size, after_size, saved_percent,
+                                      format_stages(result["stages"]), "-")
+        summary = throughput_summary(results, time.perf_counter() - start)
+        cancelled = sum(1 for result in results if result["cancelled"])
+        self.status_signal.emit(f"{summary['jobs']} videos ({cancelled} cancelled) in {summary['wall_seconds']:.1f}s: "
+                                f"{summary['speed']:.2f}x realtime, {summary['mb_per_s']:.2f} MB/s")
 
 
 class ModernCompressorApp(QWidget):
     def __init__(self):
         super().__init__()
+        self.cache = ResultCache()
+        self.cancel_event = None
         self.initUI()
 
     def initUI(self):
@@ -74,16 +162,91 @@ class ModernCompressorApp(QWidget):
         self.slider.valueChanged.connect(self.update_slider_label)
         layout.addWidget(self.slider)
 
+        # Target Size (slider becomes the upper quality bound)
+        target_layout = QHBoxLayout()
+        self.target_size_check = QCheckBox("Target Size (KB):")
+        target_layout.addWidget(self.target_size_check)
+        self.target_size_spin = QSpinBox()
+        self.target_size_spin.setRange(10, 100000)
+        self.target_size_spin.setValue(200)
+        target_layout.addWidget(self.target_size_spin)
+        layout.addLayout(target_layout)
+
+        # Minimum SSIM (slider only seeds the quality search)
+        ssim_layout = QHBoxLayout()
+        self.min_ssim_check = QCheckBox("Minimum SSIM:")
+        ssim_layout.addWidget(self.min_ssim_check)
+        self.min_ssim_spin = QDoubleSpinBox()
+        self.min_ssim_spin.setDecimals(3)
+        self.min_ssim_spin.setRange(0.5, 0.999)
+        self.min_ssim_spin.setSingleStep(0.005)
+        self.min_ssim_spin.setValue(0.95)
+        ssim_layout.addWidget(self.min_ssim_spin)
+        layout.addLayout(ssim_layout)
+
+        # Near-duplicate detection for batch images (max Hamming distance of the perceptual hashes)
+        dedup_layout = QHBoxLayout()
+        self.dedup_check = QCheckBox("Reuse Near-Duplicates, Distance:")
+        dedup_layout.addWidget(self.dedup_check)
+        self.dedup_spin = QSpinBox()
+        self.dedup_spin.setRange(0, 20)
+        self.dedup_spin.setValue(DEFAULT_MAX_DISTANCE)
+        dedup_layout.addWidget(self.dedup_spin)
+        layout.addLayout(dedup_layout)
+
+        # Worker Processes for batch images
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("Worker Processes:"))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setMinimum(1)
+        self.workers_spin.setMaximum(default_workers())
+        self.workers_spin.setValue(default_workers())
+        workers_layout.addWidget(self.workers_spin)
+        layout.addLayout(workers_layout)
+
+        # Output Format ("Auto" keeps the smallest of the available formats)
+        format_layout = QHBoxLayout()
+        format_layout.addWidget(QLabel("Image Format:"))
+        self.format_combo = QComboBox()
+        self.format_combo.addItems(["JPEG", "WEBP"] + (["AVIF"] if AVIF_AVAILABLE else []) + ["Auto"])
+        format_layout.addWidget(self.format_combo)
+        layout.addLayout(format_layout)
+
+        # Exact resampling skips the fast reduced-scale decode
+        self.exact_resize = QCheckBox("Exact LANCZOS Resize (slower)")
+        layout.addWidget(self.exact_resize)
+
+        # Pre-flight check for videos
+        self.preflight_check = QCheckBox("Skip Videos That Won't Shrink (sample encode first)")
+        layout.addWidget(self.preflight_check)
+
+        # Long videos split into keyframe-aligned chunks encoded in parallel
+        self.segmented_check = QCheckBox("Segmented Encoding For Long Videos")
+        layout.addWidget(self.segmented_check)
+
         # Progress Bar
         self.progress_bar = QProgressBar(self)
         layout.addWidget(self.progress_bar)
 
         # Table for Stats
         self.table = QTableWidget()
-        self.table.setColumnCount(4)
-        self.table.setHorizontalHeaderLabels(["File", "Before (KB)", "After (KB)", "Saved (%)"])
+        self.table.setColumnCount(6)
+        self.table.setHorizontalHeaderLabels(["File", "Before (KB)", "After (KB)", "Saved (%)", "SSIM", "Stages"])
         layout.addWidget(self.table)
 
+        # Batch Status
+        self.status_label = QLabel("")
+        layout.addWidget(self.status_label)
+
+        # Cancel Running Video Jobs
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_jobs)
+        layout.addWidget(self.cancel_button)
+
+        # Result Cache Counters
+        self.cache_label = QLabel("Cache: 0 hits / 0 misses")
+        layout.addWidget(self.cache_label)
+
         # Reset Button
         self.reset_button = QPushButton("Reset")
         self.reset_button.clicked.connect(self.reset_fields)
@@ -111,40 +274,61 @@ class ModernCompressorApp(QWidget):
         self.progress_bar.setValue(0)
         self.table.setRowCount(0)
 
-    def update_table(self, filename, before, after, saved):
+    def update_table(self, filename, before, after, saved, stages="-", score="-"):
         row_position = self.table.rowCount()
         self.table.insertRow(row_position)
         self.table.setItem(row_position, 0, QTableWidgetItem(filename))
         self.table.setItem(row_position, 1, QTableWidgetItem(str(before)))
         self.table.setItem(row_position, 2, QTableWidgetItem(str(after)))
         self.table.setItem(row_position, 3, QTableWidgetItem(f"{saved:.2f}%"))
+        self.table.setItem(row_position, 4, QTableWidgetItem(score))
+        self.table.setItem(row_position, 5, QTableWidgetItem(stages))
 
     def compress_single_image(self):
         file, _ = QFileDialog.getOpenFileName(self, "Select Image", "", "Image Files (*.jpg *.jpeg *.png)")
         if file:
-            output_format = "jpg"
-            output_path, _ = QFileDialog.getSaveFileName(self, "Save Compressed Image", "", f"{output_format.upper()} Files (*.{output_format})")
+            output_format = self.format_combo.currentText()
+            extension = FORMAT_EXTENSIONS.get(output_format.upper(), ".jpg").lstrip(".")
+            output_path, _ = QFileDialog.getSaveFileName(self, "Save Compressed Image", output_name(file, output_format),
+                                                         f"{output_format.upper()} Files (*.{extension})")
             if output_path:
                 before_size = os.path.getsize(file) // 1024
-                if compress_image(file, output_path, quality=self.slider.value()):
+                stats = compress_image(file, output_path, quality=self.slider.value(), cache=self.cache,
+                                       **self.image_options())
+                if stats:
+                   output_path = stats["output"]
                    after_size = os.path.getsize(output_path) // 1024
                    saved_percent = ((before_size - after_size) / before_size) * 100 if before_size > after_size else 0
-                   self.update_table(os.path.basename(file), before_size, after_size, saved_percent)
+                   self.update_table(os.path.basename(file), before_size, after_size, saved_percent,
+                                     format_stages(stats["stages"]), format_score(stats.get("ssim")))
                    self.progress_bar.setValue(100)
-            else:
-                   print("image compression failed!")    
+                   self.update_cache_label()
+                   self.status_label.setText(f"Saved {os.path.basename(output_path)} ({stats['format']})")
+                else:
+                   logger.error("Image compression failed: %s", file)
 
     def compress_single_video(self):
         file, _ = QFileDialog.getOpenFileName(self, "Select Video", "", "Video Files (*.mp4 *.avi *.mkv)")
         if file:
             output_path, _ = QFileDialog.getSaveFileName(self, "Save Compressed Video", "", "*.mp4")
             if output_path:
-                before_size = os.path.getsize(file) // 1024
-                compress_video(file, output_path, crf=23)
-                after_size = os.path.getsize(output_path) // 1024
-                saved_percent = ((before_size - after_size) / before_size) * 100 if before_size > after_size else 0
-                self.update_table(os.path.basename(file), before_size, after_size, saved_percent)
-                self.progress_bar.setValue(100)
+                # Same worker thread as the batch path, so probing, pre-flight
+                # and encoding never block the event loop
+                self.progress_bar.setValue(0)
+                self.progress_bar.setMaximum(100)
+                self.thread = self.make_thread([file], os.path.dirname(output_path), compress_video, [output_path])
+                self.thread.progress_signal.connect(self.update_single_video_result)
+                self.thread.job_progress_signal.connect(self.update_single_video_progress)
+                self.thread.start()
+
+    def update_single_video_progress(self, info):
+        if info["percent"] is not None:
+            self.progress_bar.setValue(int(info["percent"]))
+
+    def update_single_video_result(self, value, filename, before_size, after_size, saved_percent, stages, score):
+        self.progress_bar.setValue(100)
+        self.update_table(filename, before_size, after_size, saved_percent, stages, score)
+        self.update_cache_label()
 
     def compress_batch_images(self):
         files, _ = QFileDialog.getOpenFileNames(self, "Select Images", "", "Image Files (*.jpg *.jpeg *.png)")
@@ -161,16 +345,50 @@ class ModernCompressorApp(QWidget):
     def start_thread(self, files, output_dir, function):
         self.progress_bar.setValue(0)
         self.progress_bar.setMaximum(len(files))
-        self.thread = CompressionThread(files, output_dir, function, self.slider.value())
+        self.thread = self.make_thread(files, output_dir, function)
         self.thread.progress_signal.connect(self.update_progress)
         self.thread.start()
 
-    def update_progress(self, value, filename, before_size, after_size, saved_percent):
+    def make_thread(self, files, output_dir, function, outputs=None):
+        self.cancel_event = threading.Event()
+        thread = CompressionThread(files, output_dir, function, self.slider.value(), self.workers_spin.value(),
+                                   self.image_options(), self.cache, self.cancel_event, self.video_options(),
+                                   self.dedup_spin.value() if self.dedup_check.isChecked() else None, outputs)
+        thread.status_signal.connect(self.status_label.setText)
+        thread.job_progress_signal.connect(self.update_job_progress)
+        return thread
+
+    def image_options(self):
+        target_bytes = self.target_size_spin.value() * 1024 if self.target_size_check.isChecked() else None
+        min_ssim = self.min_ssim_spin.value() if self.min_ssim_check.isChecked() else None
+        return {"exact": self.exact_resize.isChecked(), "target_bytes": target_bytes,
+                "output_format": self.format_combo.currentText(), "min_ssim": min_ssim}
+
+    def video_options(self):
+        return {"preflight": self.preflight_check.isChecked(), "segmented": self.segmented_check.isChecked()}
+
+    def update_progress(self, value, filename, before_size, after_size, saved_percent, stages, score):
         self.progress_bar.setValue(value)
-        self.update_table(filename, before_size, after_size, saved_percent)
+        self.update_table(filename, before_size, after_size, saved_percent, stages, score)
+        self.update_cache_label()
+
+    def update_job_progress(self, info):
+        eta = f"{info['eta']:.0f}s" if info["eta"] is not None else "?"
+        self.status_label.setText(f"{os.path.basename(info['input'])}: {info['out_time']:.0f}s encoded, "
+                                  f"{info['fps']:.0f} fps, {info['speed']:.2f}x, ETA {eta}")
+
+    def cancel_jobs(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.status_label.setText("Cancelling...")
+
+    def update_cache_label(self):
+        stats = self.cache.stats()
+        self.cache_label.setText(f"Cache: {stats['hits']} hits / {stats['misses']} misses")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     app = QApplication(sys.argv)
     window = ModernCompressorApp()
     window.show()
@@ -1,38 +1,840 @@
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from PIL import Image, ImageCms, __version__ as PILLOW_VERSION
+from io import BytesIO
+import logging
+import math
 import os
+import threading
+import time
 
-def compress_image(input_path, output_path, quality=75, resize=True):
+import numpy as np
+
+from metrics import REGISTRY, StageTimer, current_rss_mb
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pillow_avif  # noqa: F401  (registers AVIF on Pillow builds without it)
+except ImportError:
+    pass
+Image.init()
+AVIF_AVAILABLE = "AVIF" in Image.SAVE
+
+try:
+    import pyvips
+except (ImportError, OSError):  # OSError: pyvips installed but libvips missing
+    pyvips = None
+VIPS_AVAILABLE = pyvips is not None
+# pyvips logs every pipeline step at INFO
+logging.getLogger("pyvips").setLevel(logging.WARNING)
+
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "AVIF": ".avif"}
+
+# Quality offsets that roughly match each codec's perceptual quality to the
+# JPEG quality scale (AVIF holds up at much lower nominal settings)
+QUALITY_OFFSETS = {"JPEG": 0, "WEBP": 0, "AVIF": -20}
+
+# Screenshot-like content (few distinct colours) also races lossless WebP
+SCREENSHOT_MAX_COLORS = 2048
+
+# Integer pre-reduction runs while the image is this many times the target
+# size; the final LANCZOS pass only resamples the remaining factor.
+REDUCING_GAP = 3.0
+
+# Images above this many pixels are resampled in horizontal strips of
+# about STRIP_PIXELS input pixels (see decode_strips). Larger outputs than
+# MAX_OUTPUT_PIXELS are refused.
+LARGE_IMAGE_PIXELS = 64_000_000
+STRIP_PIXELS = 4_000_000
+MAX_OUTPUT_PIXELS = 400_000_000
+
+# Banded decoding rewrites Pillow internals (tile extents, _size), so it is
+# only enabled on the Pillow releases it has been verified against
+BANDED_DECODE = (10, 0) <= tuple(int(part) for part in PILLOW_VERSION.split(".")[:2]) < (13, 0)
+
+# Lowest quality the target-size search will go down to
+MIN_QUALITY = 10
+
+# Quality range and first gallop step of the SSIM search
+MAX_QUALITY = 95
+SSIM_STEP = 5
+
+# SSIM is computed on the luma plane downscaled to this longest side,
+# with a uniform window of SSIM_WINDOW x SSIM_WINDOW pixels
+SSIM_MAX_SIDE = 512
+SSIM_WINDOW = 7
+
+# Environment variable that forces an image engine ("pillow" or "vips").
+# get_engine sets it once it has picked one, so worker processes inherit
+# the choice instead of checking conformance again.
+ENGINE_ENV = "IMAGE_ENGINE"
+
+# Automatic engine choice: the first available one that passes
+# check_conformance. Fixed rather than timed, since the engine is part of
+# result cache keys and CLI manifests, which must not flip between runs.
+ENGINE_PREFERENCE = ["vips", "pillow"]
+
+# Self-benchmark input (longest side) and timed rounds per engine
+BENCHMARK_SIZE = 2048
+BENCHMARK_ROUNDS = 3
+
+def image_cache_params(quality=75, resize=True, width=None, height=None, exact=False, target_bytes=None,
+                       output_format="JPEG", min_ssim=None, engine=None):
+    """
+    Effective compression parameters, as used for result cache keys.
+    `engine` is the engine name, default get_engine()'s: engines resize and
+    encode differently, so their outputs are cached separately.
+    """
+    if not resize:
+        width = height = None
+    return {"kind": "image", "quality": quality, "resize": resize, "width": width, "height": height,
+            "exact": exact, "target_bytes": target_bytes, "output_format": output_format.upper(),
+            "min_ssim": min_ssim, "engine": engine or get_engine().name}
+
+def is_path(value):
+    return isinstance(value, (str, os.PathLike))
+
+def source_name(source):
+    """
+    Printable name of a path, an uploaded file or an anonymous buffer.
+    """
+    return str(source) if is_path(source) else getattr(source, "name", "<buffer>")
+
+def source_size(source):
+    """
+    Size in bytes of a path, bytes-like object or seekable file-like object.
+    """
+    if is_path(source):
+        return os.path.getsize(source)
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer().nbytes
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source).nbytes
+    position = source.tell()
+    size = source.seek(0, os.SEEK_END)
+    source.seek(position)
+    return size
+
+def with_format_extension(path, output_format):
+    """
+    Replace a path's extension with the one for output_format.
+    """
+    return os.path.splitext(path)[0] + FORMAT_EXTENSIONS.get(output_format.upper(), ".jpg")
+
+def output_name(input_path, output_format="JPEG"):
+    """
+    compressed_<name> with the extension of the output format ("auto"
+    starts as .jpg and is renamed to the winning format).
+    """
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    return f"compressed_{stem}{FORMAT_EXTENSIONS.get(output_format.upper(), '.jpg')}"
+
+def encode_image(img, output_format="JPEG", quality=75, lossless=False):
+    """
+    Encode an RGB image to JPEG, WebP or AVIF in memory.
+    """
+    buffer = BytesIO()
+    if output_format == "WEBP":
+        img.save(buffer, "WEBP", quality=quality, lossless=lossless, method=4)
+    elif output_format == "AVIF":
+        img.save(buffer, "AVIF", quality=quality, speed=6)
+    else:
+        img.save(buffer, "JPEG", optimize=True, quality=quality)
+    return buffer
+
+def matched_quality(output_format, quality):
+    return max(1, min(100, quality + QUALITY_OFFSETS.get(output_format, 0)))
+
+def is_screenshot_like(img):
+    """
+    Few distinct colours on a nearest-neighbour thumbnail: flat UI, text, diagrams.
+    """
+    thumb = img.resize((min(img.width, 256), min(img.height, 256)), Image.NEAREST)
+    return thumb.getcolors(maxcolors=SCREENSHOT_MAX_COLORS) is not None
+
+def race_formats(img, quality):
+    """
+    Encode to JPEG, WebP and (if available) AVIF in parallel at matched
+    quality, plus lossless WebP for screenshot-like content.
+    Returns:
+        (winning format, winning buffer, {candidate: bytes}).
+    """
+    candidates = {"JPEG": ("JPEG", False), "WEBP": ("WEBP", False)}
+    if AVIF_AVAILABLE:
+        candidates["AVIF"] = ("AVIF", False)
+    if is_screenshot_like(img):
+        candidates["WEBP_LOSSLESS"] = ("WEBP", True)
+    with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+        futures = {name: pool.submit(encode_image, img, fmt, matched_quality(fmt, quality), lossless)
+                   for name, (fmt, lossless) in candidates.items()}
+        buffers = {name: future.result() for name, future in futures.items()}
+    sizes = {name: buffer.getbuffer().nbytes for name, buffer in buffers.items()}
+    winner = min(sizes, key=sizes.get)
+    return candidates[winner][0], buffers[winner], sizes
+
+def search_quality(img, target_bytes, max_quality=95, min_quality=MIN_QUALITY, output_format="JPEG"):
+    """
+    Binary-search the highest quality whose encode fits in target_bytes.
+    Falls back to min_quality when no quality fits.
+    Returns:
+        (buffer, quality, attempts) for the winning encode.
+    """
+    best = None
+    attempts = 0
+    low, high = min_quality, max(min_quality, max_quality)
+    while low <= high:
+        mid = (low + high) // 2
+        buffer = encode_image(img, output_format, mid)
+        attempts += 1
+        if buffer.getbuffer().nbytes <= target_bytes:
+            best = (buffer, mid)
+            low = mid + 1
+        else:
+            high = mid - 1
+    if best is None:
+        # Nothing fits; the last attempt was the min_quality encode
+        best = (buffer, mid)
+    return best[0], best[1], attempts
+
+def luma_plane(img, max_side=SSIM_MAX_SIDE):
+    """
+    Luma of an image as a float array, box-downscaled to max_side.
+    """
+    scale = max(img.width, img.height) / max_side
+    luma = img.convert("L")
+    if scale > 1:
+        luma = luma.resize((max(1, round(img.width / scale)), max(1, round(img.height / scale))), Image.BOX)
+    return np.asarray(luma, dtype=np.float64)
+
+def _window_mean(plane, size):
+    # Mean over every size x size window, from a summed-area table
+    table = np.pad(plane.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    return (table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]) / size ** 2
+
+def ssim(reference, candidate, window=SSIM_WINDOW):
+    """
+    Mean structural similarity of two equally sized luma planes (1.0 = identical).
+    """
+    window = min(window, *reference.shape)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_x, mean_y = _window_mean(reference, window), _window_mean(candidate, window)
+    var_x = _window_mean(reference * reference, window) - mean_x ** 2
+    var_y = _window_mean(candidate * candidate, window) - mean_y ** 2
+    covariance = _window_mean(reference * candidate, window) - mean_x * mean_y
+    score = ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) / \
+            ((mean_x ** 2 + mean_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(score.mean())
+
+def search_ssim(img, min_ssim, start_quality=75, min_quality=MIN_QUALITY, max_quality=MAX_QUALITY,
+                output_format="JPEG"):
+    """
+    Find the lowest quality whose encode scores at least min_ssim against img.
+    Gallops from start_quality to bracket the threshold, then bisects, so a
+    good start (e.g. the previous image's result) needs only a few encodes.
+    Falls back to max_quality when no quality reaches min_ssim.
+    Returns:
+        (buffer, quality, ssim score, attempts) for the winning encode.
+    """
+    reference = luma_plane(img)
+    scored = {}
+
+    def passes(quality):
+        if quality not in scored:
+            buffer = encode_image(img, output_format, quality)
+            with Image.open(buffer) as decoded:
+                scored[quality] = (buffer, ssim(reference, luma_plane(decoded)))
+        return scored[quality][1] >= min_ssim
+
+    # The answer lies in [low, high]; high is the best effort if nothing passes
+    low, high = min_quality, max_quality
+    quality = max(min_quality, min(max_quality, start_quality))
+    step = SSIM_STEP
+    if passes(quality):
+        high = quality
+        while high > low:
+            probe = max(low, high - step)
+            if not passes(probe):
+                low = probe + 1
+                break
+            high = probe
+            step *= 2
+    else:
+        low = quality + 1
+        while low <= high:
+            probe = min(high, low - 1 + step)
+            if passes(probe):
+                high = probe
+                break
+            low = probe + 1
+            step *= 2
+    while low < high:
+        mid = (low + high) // 2
+        if passes(mid):
+            high = mid
+        else:
+            low = mid + 1
+    passes(high)
+    buffer, score = scored[high]
+    return buffer, high, score, len(scored)
+
+_BOMB_LIMIT_LOCK = threading.Lock()
+
+@contextmanager
+def _without_bomb_limit():
+    # Some plugins (e.g. TIFF) repeat the decompression-bomb check on load
+    with _BOMB_LIMIT_LOCK:
+        limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+        try:
+            yield
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+def _pixel_limit():
+    with _BOMB_LIMIT_LOCK:
+        limit = Image.MAX_IMAGE_PIXELS
+    return 2 * limit if limit else None
+
+def check_input_pixels(size):
+    """
+    Pillow's decompression-bomb check: refuse images of more than twice
+    Image.MAX_IMAGE_PIXELS.
+    """
+    limit = _pixel_limit()
+    if limit and size[0] * size[1] > limit:
+        raise Image.DecompressionBombError(f"image of {size[0]}x{size[1]} pixels exceeds the limit of "
+                                           f"{limit} pixels")
+
+def within_pixel_limit(img):
+    """
+    Whether img, at its size after any draft(), can be decoded whole
+    within Pillow's limit. Larger images need decode_strips.
+    """
+    limit = _pixel_limit()
+    return not limit or img.width * img.height <= limit
+
+def is_banded(img):
+    """
+    Whether decode_strips can read img one band of rows at a time
+    (uncompressed top-down rows: TIFF strips or tiles, PPM).
+    """
+    return BANDED_DECODE and bool(img.tile) and all(_raw_stride(tile) for tile in img.tile)
+
+def open_image(source, check=True):
+    """
+    Image.open with Pillow's decompression-bomb limit, except for images
+    that decode in bands, whose memory decode_strips bounds by the output
+    size. Nothing is decoded yet. With check=False the limit is left to the
+    caller, to apply after draft() (see within_pixel_limit).
+    """
+    with _without_bomb_limit():
+        img = Image.open(source)
+    if check and not (is_banded(img) or within_pixel_limit(img)):
+        img.close()
+        check_input_pixels(img.size)
+    return img
+
+def _raw_stride(tile):
+    # Bytes per row of a top-down "raw" tile, or None if rows can't be addressed
+    decoder, (x0, _, x1, _), _, args = tile
+    if decoder != "raw":
+        return None
+    rawmode, stride, ystep = ((args, 0, 1) if isinstance(args, str) else tuple(args) + (0, 1))[:3]
+    if ystep != 1 or rawmode == "1":
+        return None
+    if stride <= 0:
+        try:
+            stride = (x1 - x0) * len(Image.new(rawmode, (1, 1)).tobytes())
+        except (ValueError, KeyError):
+            return None
+    return stride
+
+def _decode_rows(source, top, bottom):
+    # Strip/tile hack: reopen the file and keep only the tiles that cover
+    # rows [top, bottom), shifted up (and raw tiles trimmed to those rows
+    # via their byte offset), so load() decodes just that band
+    band = open_image(source)
+    tiles = [tile for tile in band.tile if tile[1][1] < bottom and tile[1][3] > top]
+    rows = []
+    for tile in tiles:
+        x0, y0, x1, y1 = tile[1]
+        offset = tile[2]
+        stride = _raw_stride(tile)
+        if stride:
+            offset += (max(y0, top) - y0) * stride
+            y0, y1 = max(y0, top), min(y1, bottom)
+        rows.append((tile, (x0, y0, x1, y1), offset))
+    band_top = min(extents[1] for _, extents, _ in rows)
+    band_bottom = max(extents[3] for _, extents, _ in rows)
+    shifted = []
+    for tile, (x0, y0, x1, y1), offset in rows:
+        extents = (x0, y0 - band_top, x1, y1 - band_top)
+        shifted.append(tile._replace(extents=extents, offset=offset) if hasattr(tile, "_replace") else
+                       (tile[0], extents, offset, tile[3]))
+    band.tile = shifted
+    band._size = (band.width, band_bottom - band_top)
+    if hasattr(band, "_tile_size"):
+        band._tile_size = band._size
+    with _without_bomb_limit():
+        band.load()
+    return band, band_top
+
+def decode_strips(img, source, size, exact=False, strip_pixels=STRIP_PIXELS):
+    """
+    Decode and resample a very large image to size in horizontal strips,
+    pasting each into the output canvas. Each strip is read with enough
+    overlap for the LANCZOS kernel, so there are no seams.
+
+    Only uncompressed files with top-down rows (see is_banded) decode one
+    band at a time, so memory is bounded by the output size. Other formats
+    are decoded whole and only the conversion and resampling run per strip;
+    JPEGs decode at a reduced DCT scale first unless exact. Anything still
+    above Pillow's pixel limit then (PNG, compressed TIFF, exact JPEG) is
+    streamed through libvips if it is installed, and refused otherwise.
+    Returns:
+        (RGB image of size, peak resident memory in MB or None).
+    """
+    if size[0] * size[1] > MAX_OUTPUT_PIXELS:
+        raise Image.DecompressionBombError(f"output of {size[0]}x{size[1]} pixels exceeds MAX_OUTPUT_PIXELS")
+    peak = current_rss_mb()
+    banded = is_banded(img)
+    if not banded:
+        if img.format == "JPEG" and not exact:
+            img.draft("RGB", size)
+        if not within_pixel_limit(img):
+            if not VIPS_AVAILABLE:
+                check_input_pixels(img.size)
+            vips = get_engine("vips")
+            image, _ = vips.load(source, True, size[0], size[1], exact)
+            canvas = vips.to_pillow(image)
+            rss = current_rss_mb()
+            return canvas, max(peak or 0.0, rss) if rss is not None else peak
+        img.load()
+
+    width, height = img.size
+    scale_y = height / size[1]
+    # LANCZOS reads 3 source pixels per output pixel on each side
+    margin = math.ceil(3 * max(1.0, scale_y)) + 1
+    rows = max(1, int(strip_pixels / width / scale_y))
+    canvas = Image.new("RGB", size)
+    for out_top in range(0, size[1], rows):
+        out_bottom = min(size[1], out_top + rows)
+        top, bottom = out_top * scale_y, out_bottom * scale_y
+        read_top, read_bottom = max(0, math.floor(top) - margin), min(height, math.ceil(bottom) + margin)
+        if banded:
+            band, band_top = _decode_rows(source, read_top, read_bottom)
+        else:
+            band, band_top = img.crop((0, read_top, width, read_bottom)), read_top
+        if band.mode != "RGB":
+            band = band.convert("RGB")
+        strip = band.resize((size[0], out_bottom - out_top), Image.LANCZOS,
+                            box=(0, top - band_top, width, bottom - band_top))
+        canvas.paste(strip, (0, out_top))
+        rss = current_rss_mb()
+        if rss is not None:
+            peak = max(peak or 0.0, rss)
+        del band, strip
+    return canvas, peak
+
+def cached_output(cache, key, output_path, output_format="JPEG"):
+    """
+    Copy a cached result out of cache, using the stored format's extension in
+    auto mode. Returns the output path on a hit, None on a miss.
+    """
+    if output_format.upper() == "AUTO":
+        output_path = with_format_extension(output_path, cache.meta(key).get("format", "JPEG"))
+    return output_path if cache.get(key, output_path) else None
+
+def target_size(size, resize=True, width=None, height=None):
+    """
+    Output size for an input of `size`: (width, height) when both are
+    given, half resolution otherwise, or unchanged without resize. Raises
+    DecompressionBombError above MAX_OUTPUT_PIXELS.
+    """
+    if not resize:
+        new_size = size
+    elif width and height:
+        new_size = (width, height)
+    else:
+        new_size = (size[0] // 2, size[1] // 2)
+    if new_size[0] * new_size[1] > MAX_OUTPUT_PIXELS:
+        raise Image.DecompressionBombError(f"output of {new_size[0]}x{new_size[1]} pixels exceeds "
+                                           "MAX_OUTPUT_PIXELS")
+    return new_size
+
+def _source_bytes(source):
+    # Bytes of an in-memory (bytes-like or file-like) source, for decoders that want a buffer
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, "getbuffer"):
+        return bytes(source.getbuffer())
+    source.seek(0)
+    return source.read()
+
+class PillowEngine:
+    """
+    Default image engine: Pillow decode (reduced-scale JPEG draft, strip
+    mode above LARGE_IMAGE_PIXELS or Pillow's pixel limit), LANCZOS resize
+    and Pillow encoders.
+    """
+    name = "pillow"
+    formats = set(FORMAT_EXTENSIONS)
+
+    def load(self, source, resize=True, width=None, height=None, exact=False, timer=None):
+        """
+        Decode, resize and convert to RGB without metadata.
+        Returns:
+            (image, peak_mb), peak_mb being None outside large-image mode.
+        """
+        timer = timer or StageTimer()
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        with open_image(source, check=False) as img:
+            new_size = target_size(img.size, resize, width, height)
+            if img.width * img.height > LARGE_IMAGE_PIXELS or not within_pixel_limit(img):
+                # Large-image mode: strip decode and resample into the output canvas
+                with timer.stage("decode"):
+                    img, peak_mb = decode_strips(img, source, new_size, exact)
+                logger.info("Large image %s decoded in strips, peak memory %s MB", source_name(source),
+                            f"{peak_mb:.0f}" if peak_mb is not None else "unknown")
+            else:
+                peak_mb = None
+                with timer.stage("decode"):
+                    if resize and not exact:
+                        # JPEGs decode straight at 1/2, 1/4 or 1/8 scale (no-op for other formats)
+                        img.draft("RGB", new_size)
+                    img.load()
+
+                # Resize Image (to width x height, or reduce to half)
+                with timer.stage("resize"):
+                    if resize:
+                        if exact:
+                            img = img.resize(new_size, Image.LANCZOS)
+                        else:
+                            img = img.resize(new_size, Image.LANCZOS, reducing_gap=REDUCING_GAP)
+
+                    # Convert to RGB if needed
+                    if img.mode != "RGB":
+                        img = img.convert("RGB")
+
+            # Remove Metadata
+            img.info.clear()
+        return img, peak_mb
+
+    def encode(self, img, output_format="JPEG", quality=75, lossless=False):
+        return encode_image(img, output_format, quality, lossless)
+
+    def to_pillow(self, img):
+        return img
+
+class VipsEngine:
+    """
+    Optional libvips engine (pip install pyvips). Pipelines are demand
+    driven: pixels stream from the decoder (shrink-on-load for JPEG and
+    WebP) through the resize to the encoder in small regions, spread over
+    libvips' own thread pool, so no strip mode is needed for large images.
+    Since evaluation is lazy, decode and resize time shows up under encode.
+    """
+    name = "vips"
+
+    def __init__(self):
+        suffixes = set(pyvips.base.get_suffixes())
+        self.formats = {fmt for fmt, ext in FORMAT_EXTENSIONS.items() if ext in suffixes}
+        # libvips 8.15 replaced strip=True with keep="none"
+        self._strip = {"keep": "none"} if pyvips.at_least_libvips(8, 15) else {"strip": True}
+
+    def load(self, source, resize=True, width=None, height=None, exact=False, timer=None):
+        """
+        As PillowEngine.load, but returns a lazy pyvips image and no peak.
+        """
+        timer = timer or StageTimer()
+        with timer.stage("decode"):
+            # Paths stream from disk; in-memory sources are handed over as one buffer
+            if is_path(source):
+                image = pyvips.Image.new_from_file(os.fspath(source), access="sequential")
+                thumbnail = pyvips.Image.thumbnail
+                source = os.fspath(source)
+            else:
+                source = _source_bytes(source)
+                image = pyvips.Image.new_from_buffer(source, "", access="sequential")
+                thumbnail = pyvips.Image.thumbnail_buffer
+            # No input pixel limit: regions stream through, so memory is bounded
+            # by the output, which target_size limits
+            new_size = target_size((image.width, image.height), resize, width, height)
+            if resize and not exact:
+                # no_rotate: Pillow doesn't apply the EXIF orientation either
+                image = thumbnail(source, new_size[0], height=new_size[1], size="force", no_rotate=True)
+        with timer.stage("resize"):
+            if resize and exact:
+                image = image.resize(new_size[0] / image.width, vscale=new_size[1] / image.height,
+                                     kernel="lanczos3")
+            # 8-bit sRGB without alpha, as Pillow's convert("RGB")
+            if image.interpretation != "srgb":
+                image = image.colourspace("srgb")
+            if image.bands > 3:
+                image = image[:3]
+            if image.format != "uchar":
+                image = image.cast("uchar")
+        return image, None
+
+    def encode(self, image, output_format="JPEG", quality=75, lossless=False):
+        if output_format == "WEBP":
+            data = image.webpsave_buffer(Q=quality, lossless=lossless, effort=4, **self._strip)
+        elif output_format == "AVIF":
+            data = image.heifsave_buffer(Q=quality, compression="av1", effort=3, **self._strip)
+        else:
+            data = image.jpegsave_buffer(Q=quality, optimize_coding=True, **self._strip)
+        return BytesIO(data)
+
+    def to_pillow(self, image):
+        pixels = np.ndarray(buffer=image.write_to_memory(), dtype=np.uint8,
+                            shape=(image.height, image.width, image.bands))
+        return Image.fromarray(pixels, "RGB")
+
+def available_engines():
+    """
+    Instances of the engines that can run here, by name.
+    """
+    engines = {"pillow": PillowEngine()}
+    if VIPS_AVAILABLE:
+        engines["vips"] = VipsEngine()
+    return engines
+
+def _sample_image(size, mode="RGB"):
+    # Deterministic test image: gradients plus noise, so encoders have real work to do
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:size[1], 0:size[0]]
+    pixels = np.stack([x * 255 // size[0], y * 255 // size[1], (x + y) * 255 // sum(size)], axis=-1)
+    pixels = np.clip(pixels + rng.normal(0, 12, pixels.shape), 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, "RGB").convert(mode)
+
+def _sample_bytes(img, fmt, **params):
+    buffer = BytesIO()
+    img.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+def check_conformance(engine):
+    """
+    Run an engine over a fixed set of inputs (alpha with an ICC profile,
+    greyscale with EXIF, palette, CMYK) and check that every output has the
+    expected dimensions, is RGB and carries no metadata.
+    Returns:
+        A list of failure descriptions, empty if the engine conforms.
+    """
+    exif = Image.Exif()
+    exif[0x010F] = "conformance"  # Make
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    cases = [
+        ("RGBA PNG with ICC, half size", _sample_bytes(_sample_image((640, 480), "RGBA"), "PNG", icc_profile=icc),
+         {}, (320, 240)),
+        ("greyscale JPEG with EXIF, 200x100", _sample_bytes(_sample_image((640, 480), "L"), "JPEG", exif=exif),
+         {"width": 200, "height": 100}, (200, 100)),
+        ("palette PNG, no resize", _sample_bytes(_sample_image((300, 200), "P"), "PNG"), {"resize": False},
+         (300, 200)),
+        ("CMYK JPEG, exact 150x100", _sample_bytes(_sample_image((600, 400), "CMYK"), "JPEG"),
+         {"width": 150, "height": 100, "exact": True}, (150, 100)),
+    ]
+    formats = [fmt for fmt in FORMAT_EXTENSIONS if fmt in engine.formats and (fmt != "AVIF" or AVIF_AVAILABLE)]
+    failures = []
+    for label, data, options, expected in cases:
+        for fmt in formats:
+            try:
+                image, _ = engine.load(data, **options)
+                with Image.open(engine.encode(image, fmt, 80)) as out:
+                    problems = []
+                    if out.size != expected:
+                        problems.append(f"size {out.size} != {expected}")
+                    if out.mode != "RGB":
+                        problems.append(f"mode {out.mode}")
+                    kept = [key for key in ("exif", "icc_profile", "xmp") if out.info.get(key)]
+                    if kept or len(out.getexif()):
+                        problems.append(f"metadata kept ({', '.join(kept) or 'exif'})")
+            except Exception as e:
+                problems = [f"error: {e}"]
+            failures += [f"{engine.name}: {label} -> {fmt}: {problem}" for problem in problems]
+    return failures
+
+def benchmark_engines(engines=None, rounds=BENCHMARK_ROUNDS):
+    """
+    Time each engine on a default-settings job (half-size resize, JPEG at
+    quality 75) over a BENCHMARK_SIZE JPEG held in memory.
+    Returns:
+        {engine name: best seconds over `rounds` runs}
+    """
+    engines = engines or available_engines()
+    data = _sample_bytes(_sample_image((BENCHMARK_SIZE, BENCHMARK_SIZE * 3 // 4)), "JPEG", quality=90)
+    seconds = {}
+    for name, engine in engines.items():
+        best = math.inf
+        for _ in range(rounds):
+            start = time.perf_counter()
+            image, _ = engine.load(data)
+            engine.encode(image, "JPEG", 75)
+            best = min(best, time.perf_counter() - start)
+        seconds[name] = best
+    return seconds
+
+_ENGINE = None
+_ENGINES = {}  # name -> instance, for engines chosen by name
+_ENGINE_LOCK = threading.Lock()
+
+def get_engine(name=None):
+    """
+    The image engine to use: `name` if given, else the one named by
+    ENGINE_ENV, else the first of ENGINE_PREFERENCE that is available and
+    passes check_conformance (checked once per process; both engines are
+    benchmarked for the log).
+    """
+    global _ENGINE
+    name = name or os.environ.get(ENGINE_ENV)
+    if name:
+        with _ENGINE_LOCK:
+            if not _ENGINES:
+                _ENGINES.update(available_engines())
+        if name not in _ENGINES:
+            raise ValueError(f"Image engine {name!r} is not available (have: {', '.join(_ENGINES)})")
+        return _ENGINES[name]
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            engines = available_engines()
+            if len(engines) > 1:
+                for engine_name, engine in list(engines.items()):
+                    failures = check_conformance(engine) if engine_name != "pillow" else []
+                    if failures:
+                        logger.warning("Image engine %s disabled: %s", engine_name, "; ".join(failures))
+                        del engines[engine_name]
+            if len(engines) > 1:
+                seconds = benchmark_engines(engines)
+                logger.info("Image engine benchmark: %s",
+                            ", ".join(f"{engine_name} {value * 1000:.0f} ms" for engine_name, value in seconds.items()))
+            _ENGINE = engines[next(engine_name for engine_name in ENGINE_PREFERENCE if engine_name in engines)]
+            logger.info("Using image engine %s", _ENGINE.name)
+            os.environ.setdefault(ENGINE_ENV, _ENGINE.name)
+        return _ENGINE
+
+
+def compress_image(input_path, output_path, quality=75, resize=True, width=None, height=None, exact=False,
+                   target_bytes=None, cache=None, output_format="JPEG", min_ssim=None, start_quality=None,
+                   engine=None):
     """
     Compress an image with optional resizing and metadata removal.
     Args:
-        input_path: Path to the original image.
-        output_path: Path to save the compressed image.
+        input_path: Path to the original image, or the image itself as a
+            bytes-like or file-like object (e.g. an upload), which is decoded
+            straight from memory.
+        output_path: Path to save the compressed image, or a writable
+            file-like object that receives the encoded bytes (auto mode
+            cannot rename it; check the returned format).
         quality: Quality of compression (1-100, lower = smaller size).
         resize: Boolean, if True resizes the image to half resolution.
+        width, height: Exact output size used instead of half resolution
+            when both are given and resize is True.
+        exact: Boolean, if True skips reduced-scale JPEG decoding and integer
+            pre-reduction and resamples the full image with LANCZOS.
+        target_bytes: Optional size limit. The image is decoded and resized
+            once, then the highest quality (up to `quality`) that fits is
+            found with in-memory encodes; only the winner is written.
+        cache: Optional ResultCache; unchanged inputs are copied from it
+            instead of being recompressed. Only used with a path output.
+        output_format: "JPEG", "WEBP", "AVIF" or "auto". Auto encodes every
+            available format in parallel (see race_formats), keeps the
+            smallest and swaps output_path's extension to match. Target-size
+            mode with auto searches in JPEG.
+        min_ssim: Optional minimum SSIM (e.g. 0.95). The lowest quality
+            whose encode reaches it is used instead of `quality`, which
+            only seeds the search. Auto searches in JPEG. Ignored when
+            target_bytes is set.
+        start_quality: Optional first guess for the SSIM search, such as
+            the quality the previous image in a batch ended up with.
+        engine: Image engine (PillowEngine or VipsEngine) that decodes,
+            resizes and encodes; defaults to get_engine().
+    Returns:
+        A dict with the output path and format, the chosen quality, the
+        number of encode attempts, the engine name, whether the result came from the cache
+        and the seconds spent per stage (plus candidate sizes and savings
+        over JPEG in auto mode, the achieved score with min_ssim and the
+        peak memory in large-image mode), or False on failure. Every call
+        is recorded in metrics.REGISTRY. With the Pillow engine, images
+        above LARGE_IMAGE_PIXELS are processed in strips (see decode_strips).
     """
+    timer = StageTimer()
+    output_format = output_format.upper()
+    name = source_name(input_path)
     try:
-        with Image.open(input_path) as img:
-            # Remove Metadata
-            img = img.copy()
-            img.info.clear()
-
-            # Resize Image (reduce to half)
-            if resize:
-                new_size = (img.width // 2, img.height // 2)
-                img = img.resize(new_size, Image.LANCZOS)  # Use LANCZOS directly
+        bytes_in = source_size(input_path)
+        if isinstance(input_path, (bytes, bytearray, memoryview)):
+            input_path = BytesIO(input_path)
+        engine = engine or get_engine()
+        cache_key = None
+        if cache is not None and is_path(output_path):
+            with timer.stage("cache"):
+                cache_key = cache.key(input_path, image_cache_params(quality, resize, width, height, exact,
+                                                                     target_bytes, output_format, min_ssim,
+                                                                     engine.name))
+                hit_path = cached_output(cache, cache_key, output_path, output_format)
+            if hit_path:
+                logger.info("Cache hit: %s", name)
+                REGISTRY.record("image", name, "cached", bytes_in, os.path.getsize(hit_path), timer.stages)
+                meta = cache.meta(cache_key)
+                return {"output": hit_path, "format": meta.get("format"), "quality": None, "attempts": 0,
+                        "engine": engine.name, "cached": True, "stages": timer.stages, "ssim": meta.get("ssim")}
 
-            # Convert to RGB if needed
-            if img.mode != "RGB":
-                img = img.convert("RGB")
+        img, peak_mb = engine.load(input_path, resize, width, height, exact, timer)
 
-            # Save compressed image
-            img.save(output_path, "JPEG", optimize=True, quality=quality)
+        # Encode in memory, then write once. Engines encode fixed-quality
+        # jobs themselves; searches and the format race run on Pillow.
+        attempts = 1
+        race = None
+        score = None
+        with timer.stage("encode"):
+            if not (target_bytes or min_ssim or output_format == "AUTO") and output_format in engine.formats:
+                fmt = output_format
+                buffer = engine.encode(img, fmt, quality)
+            else:
+                img = engine.to_pillow(img)
+                if target_bytes:
+                    fmt = "JPEG" if output_format == "AUTO" else output_format
+                    buffer, quality, attempts = search_quality(img, target_bytes, max_quality=quality,
+                                                               output_format=fmt)
+                elif min_ssim:
+                    fmt = "JPEG" if output_format == "AUTO" else output_format
+                    buffer, quality, score, attempts = search_ssim(img, min_ssim, start_quality or quality,
+                                                                   output_format=fmt)
+                elif output_format == "AUTO":
+                    fmt, buffer, race = race_formats(img, quality)
+                    attempts = len(race)
+                else:
+                    fmt = output_format
+                    buffer = encode_image(img, fmt, quality)
+        if output_format == "AUTO" and is_path(output_path):
+            output_path = with_format_extension(output_path, fmt)
+        with timer.stage("write"):
+            if is_path(output_path):
+                with open(output_path, "wb") as f:
+                    f.write(buffer.getbuffer())
+            else:
+                output_path.write(buffer.getbuffer())
 
-            # Log size
-            original_size = os.path.getsize(input_path) // 1024
-            compressed_size = os.path.getsize(output_path) // 1024
-            print(f"Original Size: {original_size} KB, Compressed Size: {compressed_size} KB")
-        return True
+        bytes_out = buffer.getbuffer().nbytes
+        logger.info("Original Size: %d KB, Compressed Size: %d KB, Quality: %d (%d encodes)",
+                    bytes_in // 1024, bytes_out // 1024, quality, attempts)
+        stats = {"output": output_path, "format": fmt, "quality": quality, "attempts": attempts,
+                 "cached": False, "engine": engine.name, "stages": timer.stages}
+        if peak_mb is not None:
+            stats["peak_mb"] = peak_mb
+        if score is not None:
+            stats["ssim"] = score
+            logger.info("SSIM %.4f at quality %d (target %.4f)", score, quality, min_ssim)
+        if race:
+            stats["candidates"] = race
+            stats["saved_vs_jpeg"] = 1 - bytes_out / race["JPEG"]
+            logger.info("Auto format: %s won (%.1f%% smaller than JPEG)", fmt, stats["saved_vs_jpeg"] * 100)
+        if cache_key:
+            with timer.stage("cache"):
+                cache.put(cache_key, output_path, {"format": fmt, "ssim": score})
+        REGISTRY.record("image", name, "ok", bytes_in, bytes_out, timer.stages)
+        return stats
     except Exception as e:
-        print(f"Error compressing image: {e}")
+        logger.error("Error compressing image %s: %s", name, e)
+        REGISTRY.record("image", name, "failed", stages=timer.stages, error=e)
         return False
@@ -0,0 +1,419 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import batch_engine
+from dedup import find_duplicates
+from image_compressor import image_cache_params, cached_output, get_engine, is_path, source_name, source_size
+from metrics import REGISTRY
+from video_compressor import compress_video_stream, probe_duration
+from video_scheduler import compress_job as compress_video_job, default_thread_budget
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.environ.get("COMPRESS_JOBS_DB", "jobs.db")
+
+# Seconds the dispatcher sleeps when there is nothing it can start
+POLL_INTERVAL = 0.5
+
+# Video progress is written to the job table at most this often
+PROGRESS_WRITE_INTERVAL = 1.0
+
+# Finished batches (rows and output files) are purged after this many seconds
+JOB_RETENTION_SECONDS = 24 * 3600
+PURGE_INTERVAL = 600
+
+# "waiting" jobs are near-duplicates that will reuse another job's output
+ACTIVE_STATUSES = ("queued", "running", "waiting")
+_ACTIVE_MARKS = ", ".join("?" * len(ACTIVE_STATUSES))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    input TEXT NOT NULL,
+    in_memory INTEGER NOT NULL DEFAULT 0,
+    megapixels REAL NOT NULL DEFAULT 0,
+    output TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    progress REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, kind, created);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user, batch_id);
+"""
+
+
+class JobQueue:
+    """
+    Background compression queue backed by a SQLite job table.
+
+    Jobs are rows with status (queued, running, waiting, done, failed, cancelled),
+    progress, timings and results, so they outlive the page that submitted
+    them. A dispatcher thread starts queued jobs as image or video slots
+    free up, always picking the user with the fewest running jobs of that
+    kind (oldest job first), so one large batch cannot starve other users.
+    Images run on a shared process pool, admitted while their decoded
+    megapixels fit in max_megapixels (as in batch_engine.compress_images),
+    videos as ffmpeg processes that split the thread budget evenly. If an
+    image worker dies (e.g. killed for running out of memory), its job fails
+    and the pool is replaced.
+
+    Inputs may be paths or in-memory uploads. Uploads are held by the queue
+    until their job starts and never written to disk: images are decoded
+    from their bytes and videos piped through ffmpeg (compress_video_stream).
+    Their rows are flagged in_memory with only the upload's name as input.
+    They do not survive a server restart; such jobs fail on restart.
+
+    With dedup, near-duplicate images in a batch wait for the one picked to
+    represent them and are finished with a copy of its output (or queued
+    normally if it fails).
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, image_workers=None, video_slots=2, video_threads=None,
+                 cache=None, max_megapixels=batch_engine.DEFAULT_MAX_MEGAPIXELS):
+        self.image_workers = image_workers or batch_engine.default_workers()
+        self.max_megapixels = max_megapixels
+        self.video_slots = video_slots
+        self.video_threads = max(1, (video_threads or default_thread_budget()) // video_slots)
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+            columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            for column, definition in (("in_memory", "INTEGER NOT NULL DEFAULT 0"),
+                                       ("megapixels", "REAL NOT NULL DEFAULT 0")):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            # Uploads died with the previous process; their names must not be
+            # mistaken for local paths
+            self._db.execute("UPDATE jobs SET status = 'failed', progress = 0, finished = ?, "
+                             f"error = 'upload lost on server restart' WHERE in_memory = 1 AND status IN "
+                             f"({_ACTIVE_MARKS})", (time.time(), *ACTIVE_STATUSES))
+            # Jobs that were running when the previous process died start over, and
+            # near-duplicates whose representative is lost run on their own
+            self._db.execute("UPDATE jobs SET status = 'queued', progress = 0, started = NULL "
+                             "WHERE status IN ('running', 'waiting')")
+        self._cancel_events = {}
+        self._payloads = {}  # job id -> in-memory input
+        self._duplicates = {}  # representative job id -> ids of the waiting near-duplicates
+        self._last_purge = 0.0
+        self._last_quality = {}  # batch_id -> quality of its latest SSIM-searched image
+        self._running = {"image": 0, "video": 0}
+        self._in_flight_mp = 0.0  # decoded megapixels of the running image jobs
+        self._running_lock = threading.Lock()
+        get_engine()  # Chosen once here and inherited by the image workers
+        self._image_pool = self._new_image_pool()
+        self._threads = ThreadPoolExecutor(max_workers=self.image_workers + video_slots)
+        self._wakeup = threading.Event()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="job-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _new_image_pool(self):
+        return ProcessPoolExecutor(max_workers=self.image_workers, initializer=batch_engine.init_worker)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock, self._db:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def submit(self, user, jobs, dedup_distance=None, **options):
+        """
+        Queue a batch of (kind, input, output_path) jobs for user. The input
+        is a path or an in-memory upload (bytes-like or file-like with a
+        name). Options are passed to compress_image or compress_video.
+        dedup_distance enables near-duplicate reuse for the batch's images
+        (see dedup.find_duplicates). Returns the batch id.
+        """
+        jobs = list(jobs)
+        megapixels = [batch_engine.image_megapixels(src) if kind == "image" else 0.0 for kind, src, _ in jobs]
+        representative_of = {}
+        if dedup_distance is not None:
+            images = [i for i, (kind, _, _) in enumerate(jobs) if kind == "image"]
+            clusters = find_duplicates([jobs[i][1] for i in images], dedup_distance, self.image_workers)
+            for representative, members in clusters.items():
+                for member in members:
+                    representative_of[images[member]] = images[representative]
+        batch_id = uuid.uuid4().hex
+        now = time.time()
+        ids = {}
+        with self._lock, self._db:
+            # Representatives first, so their ids are known to their duplicates
+            for i in sorted(range(len(jobs)), key=lambda i: i in representative_of):
+                kind, src, dst = jobs[i]
+                cursor = self._db.execute(
+                    "INSERT INTO jobs (batch_id, user, kind, input, in_memory, megapixels, output, options, status, "
+                    "created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (batch_id, user, kind, source_name(src), not is_path(src), megapixels[i], dst,
+                     json.dumps(options.get(kind, {})), "waiting" if i in representative_of else "queued", now))
+                ids[i] = cursor.lastrowid
+                if i in representative_of:
+                    self._duplicates.setdefault(ids[representative_of[i]], []).append(ids[i])
+                if not is_path(src):
+                    self._payloads[ids[i]] = src
+        self._wakeup.set()
+        return batch_id
+
+    def jobs(self, user, batch_id=None):
+        """
+        A user's jobs as dicts, newest batch first, with results decoded.
+        """
+        sql = "SELECT * FROM jobs WHERE user = ?"
+        parameters = [user]
+        if batch_id:
+            sql += " AND batch_id = ?"
+            parameters.append(batch_id)
+        rows = self._execute(sql + " ORDER BY created DESC, id", parameters)
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job["options"] = json.loads(job["options"])
+            job["result"] = json.loads(job["result"]) if job["result"] else None
+            jobs.append(job)
+        return jobs
+
+    def active(self, user):
+        """
+        Number of a user's queued or running jobs.
+        """
+        return self._execute(f"SELECT COUNT(*) FROM jobs WHERE user = ? AND status IN ({_ACTIVE_MARKS})",
+                             (user, *ACTIVE_STATUSES))[0][0]
+
+    def cancel(self, user):
+        """
+        Cancel a user's queued and waiting jobs and kill their running video
+        encodes.
+        """
+        rows = self._execute("SELECT id FROM jobs WHERE user = ? AND status = 'running'", (user,))
+        for row in rows:
+            event = self._cancel_events.get(row["id"])
+            if event is not None:
+                event.set()
+        with self._lock, self._db:
+            rows = self._db.execute("SELECT id FROM jobs WHERE user = ? AND status IN ('queued', 'waiting')",
+                                    (user,)).fetchall()
+            self._db.execute("UPDATE jobs SET status = 'cancelled', finished = ? "
+                             "WHERE user = ? AND status IN ('queued', 'waiting')", (time.time(), user))
+        for row in rows:
+            self._payloads.pop(row["id"], None)
+
+    def purge(self, max_age=JOB_RETENTION_SECONDS):
+        """
+        Delete batches that finished more than max_age seconds ago, with their
+        output files and any output folders left empty.
+        """
+        rows = self._execute(
+            "SELECT batch_id, output, result FROM jobs WHERE batch_id IN (SELECT batch_id FROM jobs "
+            f"GROUP BY batch_id HAVING SUM(status IN ({_ACTIVE_MARKS})) = 0 AND MAX(finished) < ?)",
+            (*ACTIVE_STATUSES, time.time() - max_age))
+        folders = set()
+        for row in rows:
+            result = json.loads(row["result"]) if row["result"] else {}
+            for path in {row["output"], result.get("output") or row["output"]}:
+                folders.add(os.path.dirname(path))
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        for folder in folders:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass  # Not empty or already gone
+        for batch_id in {row["batch_id"] for row in rows}:
+            self._execute("DELETE FROM jobs WHERE batch_id = ?", (batch_id,))
+
+    def _claim(self, kind, max_megapixels=None):
+        # Fair share: the user with the fewest running jobs of this kind goes
+        # first. A job above max_megapixels stays queued and blocks the others,
+        # as in compress_images, so large images are not starved.
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT * FROM jobs AS j WHERE status = 'queued' AND kind = ? ORDER BY "
+                "(SELECT COUNT(*) FROM jobs AS r WHERE r.user = j.user AND r.kind = j.kind AND r.status = 'running'), "
+                "created, id LIMIT 1", (kind,)).fetchone()
+            if row is None or (max_megapixels is not None and row["megapixels"] > max_megapixels):
+                return None
+            self._db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), row["id"]))
+        return dict(row)
+
+    def _dispatch_loop(self):
+        slots = {"image": self.image_workers, "video": self.video_slots}
+        while True:
+            if time.time() - self._last_purge > PURGE_INTERVAL:
+                self._last_purge = time.time()
+                try:
+                    self.purge()
+                except sqlite3.Error as e:
+                    logger.error("Purging old jobs failed: %s", e)
+            started = False
+            for kind, limit in slots.items():
+                while self._running[kind] < limit:
+                    # An image larger than the whole budget still runs, but on its own
+                    budget = None
+                    if kind == "image" and self._running["image"]:
+                        budget = self.max_megapixels - self._in_flight_mp
+                    job = self._claim(kind, budget)
+                    if job is None:
+                        break
+                    with self._running_lock:
+                        self._running[kind] += 1
+                        if kind == "image":
+                            self._in_flight_mp += job["megapixels"]
+                    self._threads.submit(self._run_job, job)
+                    started = True
+            if not started:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def _run_job(self, job):
+        options = json.loads(job["options"])
+        source = self._payloads.pop(job["id"], None if job["in_memory"] else job["input"])
+        try:
+            if source is None:
+                raise RuntimeError("upload lost on server restart")
+            if is_path(source) and not os.path.exists(source):
+                raise FileNotFoundError(f"input {source} is gone")
+            if job["kind"] == "image":
+                result = self._run_image(job, source, options)
+            else:
+                result = self._run_video(job, source, options)
+            result["input"] = job["input"]
+            if result.get("cancelled"):
+                status = "cancelled"
+            else:
+                status = "done" if result["ok"] else "failed"
+            self._finish(job["id"], status, result)
+        except Exception as e:
+            logger.error("Job %s (%s) failed: %s", job["id"], job["input"], e)
+            result = None
+            self._finish(job["id"], "failed", None, str(e))
+        finally:
+            self._finish_duplicates(job["id"], result)
+            self._cancel_events.pop(job["id"], None)
+            with self._running_lock:
+                self._running[job["kind"]] -= 1
+                if job["kind"] == "image":
+                    self._in_flight_mp -= job["megapixels"]
+            self._wakeup.set()
+
+    def _run_image(self, job, src, options):
+        dst = job["output"]
+        if not is_path(src):
+            # Only the encoded bytes cross to the worker process
+            src = src.getvalue() if hasattr(src, "getvalue") else bytes(src)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(src, image_cache_params(**options))
+            hit_path = cached_output(self.cache, key, dst, options.get("output_format", "JPEG"))
+            if hit_path:
+                bytes_in, bytes_out = source_size(src), os.path.getsize(hit_path)
+                REGISTRY.record("image", job["input"], "cached", bytes_in, bytes_out)
+                meta = self.cache.meta(key)
+                return {"input": src, "output": hit_path, "ok": True, "cached": True, "stages": {},
+                        "format": meta.get("format"), "ssim": meta.get("ssim"),
+                        "before_size": bytes_in // 1024, "after_size": bytes_out // 1024}
+        if options.get("min_ssim") and job["batch_id"] in self._last_quality:
+            # Seed the SSIM search from the batch's previous image, as compress_images does
+            options = dict(options, start_quality=self._last_quality[job["batch_id"]])
+        pool = self._image_pool
+        try:
+            result = pool.submit(batch_engine.compress_job, src, dst, options).result()
+        except BrokenProcessPool:
+            # A worker died and took the pool with it; later jobs get a fresh one
+            with self._running_lock:
+                if self._image_pool is pool:
+                    self._image_pool = self._new_image_pool()
+                    pool.shutdown(wait=False)
+                    logger.error("Image worker died; process pool restarted")
+            raise
+        REGISTRY.replay(result.pop("events"))
+        if result.get("ssim") is not None:
+            self._last_quality[job["batch_id"]] = result["quality"]
+        if result["ok"] and key:
+            self.cache.put(key, result["output"], {"format": result["format"], "ssim": result.get("ssim")})
+        return result
+
+    def _run_video(self, job, source, options):
+        cancel_event = threading.Event()
+        self._cancel_events[job["id"]] = cancel_event
+        last_write = [0.0]
+
+        def record_progress(info):
+            now = time.monotonic()
+            if info["percent"] is not None and now - last_write[0] >= PROGRESS_WRITE_INTERVAL:
+                last_write[0] = now
+                self._execute("UPDATE jobs SET progress = ? WHERE id = ?", (info["percent"] / 100, job["id"]))
+
+        if is_path(source):
+            options = dict(options, cache=self.cache, cancel_event=cancel_event, progress_callback=record_progress)
+            return compress_video_job(source, job["output"], self.video_threads, probe_duration(source), options)
+
+        if options.get("preflight") or options.get("segmented"):
+            # Sample encodes and segmenting need a seekable file on disk
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, os.path.basename(job["input"]))
+                with open(path, "wb") as file:
+                    source.seek(0)
+                    shutil.copyfileobj(source, file, 1024 * 1024)
+                options = dict(options, cache=self.cache, cancel_event=cancel_event,
+                               progress_callback=record_progress)
+                return compress_video_job(path, job["output"], self.video_threads, probe_duration(path), options)
+
+        before_size = source_size(source) // 1024
+        start = time.perf_counter()
+        stats = compress_video_stream(source, job["output"], options.get("crf", 23), options.get("resolution"),
+                                      options.get("bitrate"), self.video_threads, self.cache, record_progress,
+                                      cancel_event)
+        seconds = time.perf_counter() - start
+        if not stats and cancel_event.is_set():
+            return {"ok": False, "cancelled": True}
+        result = {"output": job["output"], "ok": bool(stats), "cancelled": False, "cached": False,
+                  "skipped": False, "stages": {}, "before_size": before_size, "threads": self.video_threads,
+                  "after_size": os.path.getsize(job["output"]) // 1024 if stats else None,
+                  "duration": 0.0, "seconds": seconds, "speed": 0.0,
+                  "mb_per_s": before_size / 1024 / seconds if seconds > 0 else 0.0}
+        if stats:
+            result.update(stats)
+        return result
+
+    def _finish_duplicates(self, job_id, result):
+        # Copy a finished representative's output to its waiting near-duplicates,
+        # or let them run on their own if it failed or was cancelled
+        duplicate_ids = self._duplicates.pop(job_id, [])
+        if not duplicate_ids:
+            return
+        marks = ", ".join("?" * len(duplicate_ids))
+        rows = self._execute(f"SELECT id, input, output FROM jobs WHERE id IN ({marks}) AND status = 'waiting'",
+                             duplicate_ids)
+        if not result or not result["ok"]:
+            self._execute(f"UPDATE jobs SET status = 'queued' WHERE id IN ({marks}) AND status = 'waiting'",
+                          duplicate_ids)
+            return
+        for row in rows:
+            source = self._payloads.pop(row["id"], row["input"])
+            member = next(batch_engine.duplicate_results(result, [(source, row["output"])]))
+            member["input"] = row["input"]
+            self._finish(row["id"], "done" if member["ok"] else "failed", member)
+
+    def _finish(self, job_id, status, result, error=None):
+        self._execute("UPDATE jobs SET status = ?, progress = ?, finished = ?, result = ?, error = ? WHERE id = ?",
+                      (status, 1.0 if status == "done" else 0.0, time.time(),
+                       json.dumps(result, default=str) if result is not None else None, error, job_id))
@@ -0,0 +1,81 @@
+import json
+import os
+import time
+
+from result_cache import file_digest
+
+
+class Manifest:
+    """
+    Append-only record of processed files (path, size, mtime, content hash,
+    params and result), so re-runs only touch new or changed inputs.
+
+    Every finished file is appended and flushed at once; the last line for a
+    path wins when loading, and a torn final line from an interrupted run is
+    ignored, so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()
+
+    def _load(self):
+        entries = {}
+        try:
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries[entry["path"]] = entry
+        except OSError:
+            pass
+        return entries
+
+    def needs_processing(self, key, input_path, params, retry_failed=False):
+        """
+        True unless key was already processed with the same params and content
+        (and its output still exists). Size and mtime are compared first; the
+        content hash is only computed when they differ, e.g. after a touch.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry["params"] != params:
+            return True
+        result = entry["result"]
+        if not result["ok"]:
+            return retry_failed
+        if result.get("output") and not os.path.exists(result["output"]):
+            return True
+        stat = os.stat(input_path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return False
+        if entry["size"] != stat.st_size or entry["hash"] != file_digest(input_path):
+            return True
+        # Same content, new mtime: remember it so the next run skips the hash
+        self.record(key, input_path, params, result, entry["hash"])
+        return False
+
+    def record(self, key, input_path, params, result, digest=None):
+        """
+        Append the outcome of one file and flush it to disk.
+        """
+        stat = os.stat(input_path)
+        entry = {"path": key, "size": stat.st_size, "mtime": stat.st_mtime,
+                 "hash": digest or file_digest(input_path), "params": params,
+                 "result": dict(result, time=time.time())}
+        self.entries[key] = entry
+        with open(self.path, "a") as file:
+            file.write(json.dumps(entry, default=str) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def compact(self):
+        """
+        Rewrite the manifest with one line per path.
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            for entry in self.entries.values():
+                file.write(json.dumps(entry, default=str) + "\n")
+        os.replace(tmp_path, self.path)
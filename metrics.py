@@ -0,0 +1,166 @@
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# JSON-lines event log, one event per processed file
+EVENT_LOG = os.environ.get("COMPRESS_EVENT_LOG", "compression_events.jsonl")
+
+
+class StageTimer:
+    """
+    Accumulates wall-clock seconds per named stage of one file's processing.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def format_stages(stages):
+    """
+    Compact per-stage breakdown for tables, e.g. "decode 12ms, encode 30ms".
+    """
+    if not stages:
+        return "-"
+    return ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in stages.items())
+
+
+def current_rss_mb():
+    """
+    Resident memory of this process in MB, read from /proc on Linux. Elsewhere
+    falls back to the ru_maxrss high-water mark, or None on Windows.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class Registry:
+    """
+    Per-process metrics: counters for files, bytes and failures, per-stage
+    timings, a JSON-lines event sink and a Prometheus text snapshot.
+
+    Worker processes switch to buffering with forward_events(); the parent
+    then replays the drained events so its counters cover the whole batch.
+    """
+
+    def __init__(self, event_log=EVENT_LOG):
+        self.event_log = event_log
+        self.buffering = False
+        self._buffer = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.files = {}         # (kind, status) -> count
+            self.bytes_in = {}      # kind -> bytes
+            self.bytes_out = {}     # kind -> bytes
+            self.failures = {}      # (kind, error type) -> count
+            self.stage_sum = {}     # (kind, stage) -> seconds
+            self.stage_count = {}   # (kind, stage) -> observations
+
+    def forward_events(self):
+        """
+        Buffer events instead of writing them (for pool workers).
+        """
+        self.reset()
+        self.buffering = True
+
+    def drain(self):
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        return events
+
+    def record(self, kind, input_path, status="ok", bytes_in=None, bytes_out=None, stages=None, error=None):
+        """
+        Record one processed file. error may be an exception instance.
+        """
+        event = {"time": time.time(), "kind": kind, "input": str(input_path), "status": status,
+                 "bytes_in": bytes_in, "bytes_out": bytes_out, "stages": stages or {}}
+        if error is not None:
+            event["error"] = type(error).__name__
+            event["message"] = str(error)
+        self.replay([event])
+
+    def replay(self, events):
+        """
+        Apply events to the counters and write (or buffer) them.
+        """
+        with self._lock:
+            for event in events:
+                kind = event["kind"]
+                key = (kind, event["status"])
+                self.files[key] = self.files.get(key, 0) + 1
+                if event["bytes_in"]:
+                    self.bytes_in[kind] = self.bytes_in.get(kind, 0) + event["bytes_in"]
+                if event["bytes_out"]:
+                    self.bytes_out[kind] = self.bytes_out.get(kind, 0) + event["bytes_out"]
+                if "error" in event:
+                    key = (kind, event["error"])
+                    self.failures[key] = self.failures.get(key, 0) + 1
+                for stage, seconds in event["stages"].items():
+                    key = (kind, stage)
+                    self.stage_sum[key] = self.stage_sum.get(key, 0.0) + seconds
+                    self.stage_count[key] = self.stage_count.get(key, 0) + 1
+            if self.buffering:
+                self._buffer.extend(events)
+            elif self.event_log:
+                with open(self.event_log, "a") as file:
+                    for event in events:
+                        file.write(json.dumps(event) + "\n")
+
+    def prometheus_text(self):
+        """
+        Snapshot of the counters in Prometheus text exposition format.
+        """
+        def labels(**pairs):
+            return "{" + ",".join(f'{name}="{value}"' for name, value in pairs.items()) + "}"
+
+        lines = []
+        with self._lock:
+            lines += ["# HELP compressor_files_total Files processed, by kind and status.",
+                      "# TYPE compressor_files_total counter"]
+            lines += [f"compressor_files_total{labels(kind=k, status=s)} {n}" for (k, s), n in sorted(self.files.items())]
+            lines += ["# HELP compressor_bytes_in_total Input bytes processed.",
+                      "# TYPE compressor_bytes_in_total counter"]
+            lines += [f"compressor_bytes_in_total{labels(kind=k)} {n}" for k, n in sorted(self.bytes_in.items())]
+            lines += ["# HELP compressor_bytes_out_total Output bytes written.",
+                      "# TYPE compressor_bytes_out_total counter"]
+            lines += [f"compressor_bytes_out_total{labels(kind=k)} {n}" for k, n in sorted(self.bytes_out.items())]
+            lines += ["# HELP compressor_failures_total Failed files, by kind and error type.",
+                      "# TYPE compressor_failures_total counter"]
+            lines += [f"compressor_failures_total{labels(kind=k, error=e)} {n}"
+                      for (k, e), n in sorted(self.failures.items())]
+            lines += ["# HELP compressor_stage_seconds Time spent per processing stage.",
+                      "# TYPE compressor_stage_seconds summary"]
+            for (k, stage), seconds in sorted(self.stage_sum.items()):
+                lines.append(f"compressor_stage_seconds_sum{labels(kind=k, stage=stage)} {seconds:.6f}")
+                lines.append(f"compressor_stage_seconds_count{labels(kind=k, stage=stage)} "
+                             f"{self.stage_count[(k, stage)]}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
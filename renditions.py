@@ -0,0 +1,278 @@
+"""
+Several sized variants of one asset from a single decode.
+
+    python renditions.py photo.jpg out/ --target 320:70:webp --target 1280:82:jpeg --target 2560:85:jpeg
+    python renditions.py clip.mp4 out/ --target 360:28:mp4 --target 720:23:mp4 --target 1080:21:mp4
+
+Image sizes are the longest side in pixels (or WxH), video sizes the
+output height (or WxH). A <name>.renditions.json manifest lists every
+output with its dimensions and byte size.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+
+from PIL import Image
+
+from image_compressor import (FORMAT_EXTENSIONS, LARGE_IMAGE_PIXELS, REDUCING_GAP, decode_strips, encode_image,
+                              open_image, race_formats, within_pixel_limit)
+from metrics import REGISTRY, StageTimer
+from video_compressor import _encode_single, probe_duration, probe_video
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mkv", ".mov"}
+
+# Video rendition formats: container extension -> encoder arguments
+VIDEO_CODECS = {"mp4": ["-c:v", "libx264"], "webm": ["-c:v", "libvpx-vp9", "-b:v", "0"]}
+
+
+# Other accepted names for image rendition formats
+IMAGE_FORMAT_ALIASES = {"JPG": "JPEG"}
+
+
+def fit_size(size, target):
+    """
+    Output size for a target: (width, height), scaled down to fit within
+    the source if needed, or an int longest side with the aspect ratio
+    kept. Never upscales.
+    """
+    if isinstance(target, (tuple, list)):
+        scale = min(1.0, size[0] / target[0], size[1] / target[1])
+        return max(1, round(target[0] * scale)), max(1, round(target[1] * scale))
+    scale = min(1.0, target / max(size))
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def same_aspect(size, other):
+    """
+    Whether two sizes have the same aspect ratio, up to a pixel of rounding.
+    """
+    return abs(size[0] * other[1] - size[1] * other[0]) <= max(*size, *other)
+
+
+def image_format(fmt):
+    """
+    Normalized image rendition format (JPEG, WEBP, AVIF or AUTO), or None
+    if fmt isn't one.
+    """
+    fmt = IMAGE_FORMAT_ALIASES.get(fmt.upper(), fmt.upper())
+    return fmt if fmt in FORMAT_EXTENSIONS or fmt == "AUTO" else None
+
+
+def parse_target(spec):
+    """
+    "SIZE:QUALITY:FORMAT" (e.g. "1280:82:webp" or "1280x720:23:mp4") to a
+    (size, quality, format) tuple. Raises argparse.ArgumentTypeError for
+    malformed specs and unknown formats.
+    """
+    try:
+        size, quality, fmt = spec.split(":")
+        if "x" in size:
+            size = tuple(int(part) for part in size.split("x"))
+            if len(size) != 2:
+                raise ValueError
+        else:
+            size = int(size)
+        quality = int(quality)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{spec!r} is not SIZE:QUALITY:FORMAT (e.g. 1280:82:webp)")
+    if min(size if isinstance(size, tuple) else (size,)) <= 0:
+        raise argparse.ArgumentTypeError(f"{spec!r}: sizes must be positive")
+    if fmt.lower() in VIDEO_CODECS:
+        return size, quality, fmt.lower()
+    if image_format(fmt) is None:
+        formats = sorted(FORMAT_EXTENSIONS) + ["AUTO"] + sorted(VIDEO_CODECS)
+        raise argparse.ArgumentTypeError(f"{spec!r}: unknown format {fmt!r} (use one of {', '.join(formats)})")
+    return size, quality, image_format(fmt)
+
+
+def _write_manifest(output_dir, input_path, manifest):
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    manifest_path = os.path.join(output_dir, f"{stem}.renditions.json")
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    manifest["manifest"] = manifest_path
+    return manifest
+
+
+def image_renditions(input_path, output_dir, targets):
+    """
+    Decode an image once and write one file per target, deriving each size
+    from the next larger rendition when their aspect ratios match and from
+    the decoded source otherwise.
+    Args:
+        input_path: Path to the original image.
+        output_dir: Folder for the renditions and the manifest.
+        targets: List of (size, quality, format) tuples. size is a longest
+            side or a (width, height) pair; format is JPEG, WEBP, AVIF or
+            auto (smallest of the available formats, see race_formats).
+    Returns:
+        The manifest dict (source dimensions, one entry per rendition with
+        output, width, height, format, quality and bytes, plus the manifest
+        path and stages), or False on failure.
+    """
+    timer = StageTimer()
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(input_path))[0]
+        bytes_in = os.path.getsize(input_path)
+        for _, _, fmt in targets:
+            if image_format(fmt) is None:
+                raise ValueError(f"unknown image format {fmt!r}")
+        with open_image(input_path, check=False) as img:
+            source_size = img.size
+            sized = sorted(((fit_size(img.size, size), quality, image_format(fmt)) for size, quality, fmt in targets),
+                           key=lambda target: target[0][0] * target[0][1], reverse=True)
+            # The source's aspect ratio at the smallest size that covers every target
+            scale = max(max(size[0] / img.width, size[1] / img.height) for size, _, _ in sized)
+            decode_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            with timer.stage("decode"):
+                if img.width * img.height > LARGE_IMAGE_PIXELS or not within_pixel_limit(img):
+                    img, _ = decode_strips(img, input_path, decode_size)
+                else:
+                    # JPEGs decode straight at the smallest DCT scale that still covers every target
+                    img.draft("RGB", decode_size)
+                    img.load()
+                    if img.mode != "RGB":
+                        img = img.convert("RGB")
+            img.info.clear()
+
+        renditions = []
+        current = img
+        for size, quality, fmt in sized:
+            with timer.stage("resize"):
+                if current.size != size:
+                    # A rendition of another shape would stretch this one
+                    base = current if same_aspect(current.size, size) else img
+                    current = base.resize(size, Image.LANCZOS, reducing_gap=REDUCING_GAP)
+            with timer.stage("encode"):
+                if fmt == "AUTO":
+                    fmt, buffer, _ = race_formats(current, quality)
+                else:
+                    buffer = encode_image(current, fmt, quality)
+            output_path = os.path.join(output_dir, f"{stem}_{size[0]}x{size[1]}{FORMAT_EXTENSIONS[fmt]}")
+            with timer.stage("write"):
+                with open(output_path, "wb") as f:
+                    f.write(buffer.getbuffer())
+            renditions.append({"output": output_path, "width": size[0], "height": size[1], "format": fmt,
+                               "quality": quality, "bytes": buffer.getbuffer().nbytes})
+
+        bytes_out = sum(rendition["bytes"] for rendition in renditions)
+        REGISTRY.record("image", input_path, "ok", bytes_in, bytes_out, timer.stages)
+        manifest = {"source": input_path, "width": source_size[0], "height": source_size[1], "bytes": bytes_in,
+                    "renditions": renditions}
+        return dict(_write_manifest(output_dir, input_path, manifest), stages=timer.stages)
+    except Exception as e:
+        logger.error("Error creating renditions of %s: %s", input_path, e)
+        REGISTRY.record("image", input_path, "failed", stages=timer.stages, error=e)
+        return False
+
+
+def video_renditions(input_path, output_dir, targets, threads=None, progress_callback=None, cancel_event=None):
+    """
+    Encode every target in one ffmpeg run: the input is decoded once and a
+    split filter feeds one scaler and encoder per rendition.
+    Args:
+        input_path: Path to the original video.
+        output_dir: Folder for the renditions and the manifest.
+        targets: List of (size, crf, format) tuples. size is an output
+            height (width follows the aspect ratio) or a (width, height)
+            pair; format is a key of VIDEO_CODECS.
+        threads, progress_callback, cancel_event: As for compress_video.
+    Returns:
+        The manifest dict (as for image_renditions, with crf in place of
+        quality; dimensions are None when ffprobe is unavailable), or False
+        on failure or cancellation.
+    """
+    timer = StageTimer()
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(input_path))[0]
+        bytes_in = os.path.getsize(input_path)
+        with timer.stage("probe"):
+            duration = probe_duration(input_path) if progress_callback else None
+
+        labels = "".join(f"[split{i}]" for i in range(len(targets)))
+        graph = [f"[0:v]split={len(targets)}{labels}"]
+        arguments = []
+        outputs = []
+        for i, (size, crf, fmt) in enumerate(targets):
+            scale = f"{size[0]}:{size[1]}" if isinstance(size, (tuple, list)) else f"-2:{size}"
+            graph.append(f"[split{i}]scale={scale}[out{i}]")
+            label = "x".join(map(str, size)) if isinstance(size, (tuple, list)) else f"{size}p"
+            output_path = os.path.join(output_dir, f"{stem}_{label}.{fmt}")
+            arguments += ["-map", f"[out{i}]", "-map", "0:a?"] + VIDEO_CODECS[fmt] + ["-crf", str(crf)]
+            if threads:
+                arguments += ["-threads", str(threads)]
+            outputs.append((output_path, crf, fmt))
+            if i < len(targets) - 1:
+                arguments.append(output_path)
+        arguments = ["-filter_complex", ";".join(graph)] + arguments
+
+        with timer.stage("encode"):
+            completed = _encode_single(input_path, outputs[-1][0], arguments, duration, progress_callback,
+                                       cancel_event)
+        if not completed:
+            for output_path, _, _ in outputs:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            logger.info("Cancelled: %s", input_path)
+            REGISTRY.record("video", input_path, "cancelled", bytes_in, stages=timer.stages)
+            return False
+
+        renditions = []
+        with timer.stage("probe"):
+            source = probe_video(input_path) or {}
+            for output_path, crf, fmt in outputs:
+                info = probe_video(output_path) or {}
+                renditions.append({"output": output_path, "width": info.get("width"), "height": info.get("height"),
+                                   "format": fmt, "crf": crf, "bytes": os.path.getsize(output_path)})
+
+        bytes_out = sum(rendition["bytes"] for rendition in renditions)
+        REGISTRY.record("video", input_path, "ok", bytes_in, bytes_out, timer.stages)
+        manifest = {"source": input_path, "width": source.get("width"), "height": source.get("height"),
+                    "bytes": bytes_in, "renditions": renditions}
+        return dict(_write_manifest(output_dir, input_path, manifest), stages=timer.stages)
+    except subprocess.CalledProcessError as e:
+        logger.error("Error creating renditions of %s: %s", input_path, e.stderr)
+        REGISTRY.record("video", input_path, "failed", stages=timer.stages, error=e)
+        return False
+    except Exception as e:
+        logger.error("Unexpected error creating renditions of %s: %s", input_path, e)
+        REGISTRY.record("video", input_path, "failed", stages=timer.stages, error=e)
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create sized renditions of an image or video")
+    parser.add_argument("input", help="Image or video file")
+    parser.add_argument("output", help="Output directory")
+    parser.add_argument("--target", action="append", required=True, type=parse_target,
+                        help="SIZE:QUALITY:FORMAT, e.g. 1280:82:webp or 720:23:mp4 (repeatable)")
+    parser.add_argument("--threads", type=int, help="ffmpeg threads for video")
+    args = parser.parse_args(argv)
+
+    is_video = os.path.splitext(args.input)[1].lower() in VIDEO_EXTENSIONS
+    wrong = [fmt for _, _, fmt in args.target if (fmt in VIDEO_CODECS) != is_video]
+    if wrong:
+        parser.error(f"format {wrong[0]} does not apply to {'videos' if is_video else 'images'}")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if is_video:
+        manifest = video_renditions(args.input, args.output, args.target, threads=args.threads)
+    else:
+        manifest = image_renditions(args.input, args.output, args.target)
+    if not manifest:
+        return 1
+    for rendition in manifest["renditions"]:
+        print(f"{rendition['output']}: {rendition['width']}x{rendition['height']}, {rendition['bytes'] // 1024} KB")
+    print(f"Manifest written to {manifest['manifest']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.environ.get("COMPRESS_CACHE_DIR", ".compress_cache")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+
+# Temporary files older than this are leftovers of interrupted writes
+STALE_TMP_SECONDS = 3600
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of a file's contents, read in chunks. Also accepts bytes-like
+    and seekable file-like objects (e.g. uploads held in memory).
+    """
+    digest = hashlib.sha256()
+    if isinstance(path, (bytes, bytearray, memoryview)):
+        digest.update(path)
+    elif hasattr(path, "getbuffer"):
+        digest.update(path.getbuffer())
+    elif hasattr(path, "read"):
+        position = path.tell()
+        path.seek(0)
+        for chunk in iter(lambda: path.read(chunk_size), b""):
+            digest.update(chunk)
+        path.seek(position)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Disk-backed cache of compressed outputs, keyed on the input bytes plus
+    every effective compression parameter, with LRU eviction over a size cap.
+
+    Each entry is a file named by its key with its metadata in a <key>.json
+    sidecar, and the file's modification time records its last use. There
+    is no shared index to overwrite, so the GUI, CLI and web app can share
+    one cache directory and eviction sees every entry on disk.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._import_index()
+
+    def _import_index(self):
+        # Caches written by earlier versions kept all metadata in index.json
+        index_path = os.path.join(self.cache_dir, "index.json")
+        try:
+            with open(index_path, "r") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return
+        for key, entry in index.items():
+            if os.path.exists(self._entry_path(key)) and not os.path.exists(self._meta_path(key)):
+                self._write_meta(key, entry.get("meta", {}))
+        try:
+            os.remove(index_path)
+        except OSError:
+            pass
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _tmp_path(self, path):
+        # Unique per process and thread; renamed into place when complete
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def _write_meta(self, key, meta):
+        tmp_path = self._tmp_path(self._meta_path(key))
+        with open(tmp_path, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, self._meta_path(key))
+
+    def key(self, input_path, params):
+        """
+        Cache key for an input (path, bytes or file-like) and a dict of
+        effective parameters.
+        """
+        payload = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(f"{file_digest(input_path)}:{payload}".encode()).hexdigest()
+
+    def get(self, key, output_path):
+        """
+        Copy a cached result to output_path. Returns True on a hit.
+        """
+        try:
+            shutil.copyfile(self._entry_path(key), output_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        try:
+            os.utime(self._entry_path(key))
+        except OSError:
+            pass  # Evicted meanwhile by another process
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def meta(self, key):
+        """
+        Metadata stored with an entry (e.g. the output format), or {}.
+        """
+        try:
+            with open(self._meta_path(key), "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def put(self, key, output_path, meta=None):
+        """
+        Store a freshly compressed output and evict least recently used entries.
+        """
+        tmp_path = self._tmp_path(self._entry_path(key))
+        shutil.copyfile(output_path, tmp_path)
+        # Metadata first, so a visible entry always has it
+        self._write_meta(key, meta or {})
+        os.replace(tmp_path, self._entry_path(key))
+        self._evict()
+
+    def _entries(self):
+        # (last used, size, key) of every entry on disk, whichever process wrote it.
+        # Leftovers of interrupted writes are removed once they are an hour old.
+        entries = []
+        now = time.time()
+        with os.scandir(self.cache_dir) as items:
+            for item in items:
+                try:
+                    stat = item.stat()
+                    if item.name.endswith(".tmp"):
+                        if now - stat.st_mtime > STALE_TMP_SECONDS:
+                            os.remove(item.path)
+                    elif "." not in item.name and item.is_file():
+                        entries.append((stat.st_mtime, stat.st_size, item.name))
+                except OSError:
+                    continue  # Removed meanwhile
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (self._entry_path(key), self._meta_path(key)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(entries),
+                    "bytes": sum(size for _, size, _ in entries)}
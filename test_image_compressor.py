@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_compressor import PillowEngine, compress_image, decode_strips, is_banded, open_image
+
+
+def _gradient(size):
+    y, x = np.mgrid[0:size[1], 0:size[0]]
+    pixels = np.stack([x * 255 // size[0], y * 255 // size[1], (x * 7 + y * 3) % 256], axis=-1)
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+@pytest.mark.parametrize("extension", [".tif", ".ppm"])
+def test_decode_strips_matches_whole_resize(tmp_path, extension):
+    path = str(tmp_path / f"source{extension}")
+    _gradient((640, 480)).save(path)
+    expected = Image.open(path).convert("RGB").resize((200, 150), Image.LANCZOS)
+    with open_image(path) as img:
+        assert is_banded(img)
+        # Small strips, so the image is read in many bands
+        result, _ = decode_strips(img, path, (200, 150), exact=True, strip_pixels=20_000)
+    difference = np.abs(np.asarray(result, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+    assert difference.max() <= 1
+
+
+def test_jpeg_limit_applies_to_reduced_decode(tmp_path, monkeypatch):
+    path = str(tmp_path / "source.jpg")
+    _gradient((800, 600)).save(path)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100_000)
+    stats = compress_image(path, str(tmp_path / "out.jpg"), width=200, height=150,
+                           engine=PillowEngine())
+    assert stats and Image.open(stats["output"]).size == (200, 150)
@@ -0,0 +1,8 @@
+import pytest
+
+from image_compressor import available_engines, check_conformance
+
+
+@pytest.mark.parametrize("name", sorted(available_engines()))
+def test_engine_conformance(name):
+    assert check_conformance(available_engines()[name]) == []
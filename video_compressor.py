@@ -1,31 +1,636 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
 import subprocess
+import threading
+import tempfile
+import shutil
+import logging
+import queue
+import json
+import time
 import os
 
-def compress_video(input_path, output_path, crf=23):
+from metrics import REGISTRY, StageTimer
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_PATH = os.environ.get(
+    "FFMPEG_PATH", r"C:\Users\HP\Desktop\imgvid\ffmpeg-7.1-full_build\ffmpeg-7.1-full_build\bin\ffmpeg.exe")
+FFPROBE_PATH = os.environ.get(
+    "FFPROBE_PATH", r"C:\Users\HP\Desktop\imgvid\ffmpeg-7.1-full_build\ffmpeg-7.1-full_build\bin\ffprobe.exe")
+
+# Pre-flight decisions (predicted vs actual size) are appended here for tuning
+PREFLIGHT_LOG = os.environ.get("COMPRESS_PREFLIGHT_LOG", "preflight_log.jsonl")
+
+# Segmented encoding: inputs shorter than this run as one ffmpeg process
+MIN_SEGMENTED_DURATION = 120.0
+SEGMENT_SECONDS = 30.0
+
+# Top-level boxes an MP4/MOV file can start with (anything else, e.g. an AVI
+# RIFF header, is not checked for moov placement)
+ISO_LEADING_BOXES = {b"ftyp", b"wide", b"free", b"skip", b"pnot"}
+
+def video_cache_params(crf=23, resolution=None, bitrate=None, encoder="libx264"):
+    """
+    Effective compression parameters, as used for result cache keys.
+    """
+    return {"kind": "video", "crf": crf, "resolution": resolution,
+            "bitrate": bitrate, "encoder": encoder}
+
+def probe_duration(input_path):
+    """
+    Duration of a media file in seconds via ffprobe (0.0 if unknown).
+    """
+    command = [FFPROBE_PATH, "-v", "error", "-show_entries", "format=duration",
+               "-of", "default=noprint_wrappers=1:nokey=1", input_path]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        return float(result.stdout.strip())
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        return 0.0
+
+def probe_video(input_path):
+    """
+    Probe codec, bitrate (bits/s), resolution, duration (s) and size (bytes)
+    of a video's first video stream. Returns None if ffprobe fails.
+    """
+    command = [FFPROBE_PATH, "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "stream=codec_name,width,height,bit_rate:format=duration,bit_rate,size",
+               "-of", "json", input_path]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        data = json.loads(result.stdout)
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        return None
+    stream = (data.get("streams") or [{}])[0]
+    fmt = data.get("format", {})
+    return {"codec": stream.get("codec_name"), "width": stream.get("width"), "height": stream.get("height"),
+            "bitrate": int(_to_float(fmt.get("bit_rate") or stream.get("bit_rate"))),
+            "duration": _to_float(fmt.get("duration")),
+            "size": int(_to_float(fmt.get("size"))) or os.path.getsize(input_path)}
+
+def encode_arguments(crf=23, resolution=None, bitrate=None, threads=None):
+    """
+    The libx264 output arguments shared by full, sample and segment encodes.
+    """
+    arguments = ["-vcodec", "libx264", "-crf", str(crf)]
+    if resolution:
+        arguments += ["-vf", f"scale={resolution}"]
+    if bitrate:
+        arguments += ["-b:v", bitrate]
+    if threads:
+        arguments += ["-threads", str(threads)]
+    return arguments
+
+def predict_size(input_path, duration, crf=23, resolution=None, bitrate=None, threads=None,
+                 samples=3, sample_seconds=2.0):
+    """
+    Predict the output size in bytes by encoding a few short segments spread
+    over the input with the requested settings and extrapolating their bytes
+    per second to the full duration. Short inputs are sampled whole.
+    """
+    if duration <= samples * sample_seconds * 1.5:
+        segments = [(0.0, duration)]
+    else:
+        segments = [(duration * (i + 1) / (samples + 1) - sample_seconds / 2, sample_seconds)
+                    for i in range(samples)]
+    sample_bytes = 0
+    sample_time = 0.0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (start, length) in enumerate(segments):
+            sample_path = os.path.join(tmp_dir, f"sample_{i}.mp4")
+            command = [FFMPEG_PATH, "-y", "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", input_path]
+            command += encode_arguments(crf, resolution, bitrate, threads) + [sample_path]
+            subprocess.run(command, capture_output=True, text=True, check=True)
+            sample_bytes += os.path.getsize(sample_path)
+            sample_time += length
+    return int(sample_bytes / sample_time * duration) if sample_time > 0 else None
+
+def _log_preflight(record):
+    with open(PREFLIGHT_LOG, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+def _to_float(value, default=0.0):
+    try:
+        return float(value.rstrip("x"))
+    except (AttributeError, ValueError):
+        return default
+
+def progress_info(input_path, fields, duration):
+    """
+    Turn one block of ffmpeg -progress key=value fields into encoded time,
+    fps, speed multiplier, percent done and ETA (seconds, None if unknown).
+    """
+    out_time = _to_float(fields.get("out_time_us")) / 1_000_000
+    speed = _to_float(fields.get("speed"))
+    eta = None
+    percent = None
+    if duration:
+        percent = min(100.0, out_time / duration * 100)
+        if speed > 0:
+            eta = max(0.0, (duration - out_time) / speed)
+    return {"input": input_path, "out_time": out_time, "fps": _to_float(fields.get("fps")),
+            "speed": speed, "percent": percent, "eta": eta, "done": fields.get("progress") == "end"}
+
+def _encode_single(input_path, output_path, arguments, duration, progress_callback, cancel_event):
+    """
+    Encode in one ffmpeg process, streaming -progress to progress_callback.
+    Returns False if cancelled.
+    """
+    command = [
+        FFMPEG_PATH,
+        "-y",  # Overwrite existing output file
+        "-i", input_path,
+    ]
+    command += arguments + ["-progress", "pipe:1", "-nostats", output_path]
+
+    logger.info("Running FFmpeg Command: %s", " ".join(command))
+    cancelled = False
+    with tempfile.TemporaryFile() as stderr_file:
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, text=True) as process:
+            fields = {}
+            for line in process.stdout:
+                key, _, value = line.strip().partition("=")
+                fields[key] = value
+                if key != "progress":
+                    continue
+                if cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                    process.kill()
+                    break
+                if progress_callback:
+                    progress_callback(progress_info(input_path, fields, duration))
+            returncode = process.wait()
+
+        if cancelled:
+            return False
+        if returncode != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(returncode, command,
+                                                stderr=stderr_file.read().decode(errors="replace"))
+    return True
+
+def _run_ffmpeg(command, cancel_event=None):
+    """
+    Run an ffmpeg command to completion, killing it once cancel_event is set.
+    Returns False if cancelled.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        with subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr_file) as process:
+            while True:
+                try:
+                    returncode = process.wait(timeout=0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancel_event is not None and cancel_event.is_set():
+                        process.kill()
+                        process.wait()
+                        return False
+        if returncode != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(returncode, command,
+                                                stderr=stderr_file.read().decode(errors="replace"))
+    return True
+
+def probe_streams(input_path):
+    """
+    Container duration and the duration of the first video and audio
+    streams, in seconds (None where ffprobe reports none).
+    """
+    command = [FFPROBE_PATH, "-v", "error", "-show_entries", "stream=codec_type,duration:format=duration",
+               "-of", "json", input_path]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)
+    durations = {"format": _to_float(data.get("format", {}).get("duration"), None), "video": None, "audio": None}
+    for stream in data.get("streams", []):
+        kind = stream.get("codec_type")
+        if kind in ("video", "audio") and durations[kind] is None:
+            durations[kind] = _to_float(stream.get("duration"), None)
+    return durations
+
+def verify_segmented(input_path, output_path, tolerance=0.5, max_drift=0.1):
+    """
+    Check that a segmented encode kept the input's total duration and its
+    audio/video alignment. Raises RuntimeError on a mismatch.
+    """
+    source = probe_streams(input_path)
+    result = probe_streams(output_path)
+    if source["format"] and result["format"]:
+        allowed = max(tolerance, source["format"] * 0.01)
+        if abs(source["format"] - result["format"]) > allowed:
+            raise RuntimeError(f"duration {result['format']:.2f}s, expected {source['format']:.2f}s")
+    if None not in (source["video"], source["audio"], result["video"], result["audio"]):
+        drift = abs((result["video"] - result["audio"]) - (source["video"] - source["audio"]))
+        if drift > max_drift:
+            raise RuntimeError(f"audio/video drift of {drift:.3f}s")
+
+def encode_segmented(input_path, output_path, duration, crf=23, resolution=None, bitrate=None, threads=None,
+                     segment_seconds=SEGMENT_SECONDS, workers=None, progress_callback=None, cancel_event=None):
+    """
+    Split the video stream at keyframes (stream copy), encode the chunks
+    concurrently with identical settings, concatenate them losslessly and
+    mux the original audio back in.
+    Returns:
+        True on success, False if cancelled, None if the input yields fewer
+        than two chunks (nothing to parallelise). Raises RuntimeError if the
+        result fails verify_segmented.
+    """
+    budget = threads or os.cpu_count() or 1
+    workers = workers or max(2, budget // 4)
+    chunk_threads = max(1, budget // workers)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        split_command = [FFMPEG_PATH, "-y", "-i", input_path, "-map", "0:v:0", "-c", "copy",
+                         "-f", "segment", "-segment_time", str(segment_seconds), "-reset_timestamps", "1",
+                         os.path.join(tmp_dir, "chunk_%04d.mp4")]
+        if not _run_ffmpeg(split_command, cancel_event):
+            return False
+        chunks = sorted(name for name in os.listdir(tmp_dir) if name.startswith("chunk_"))
+        if len(chunks) < 2:
+            return None
+
+        logger.info("Encoding %d segments with %d workers: %s", len(chunks), workers, input_path)
+        start = time.perf_counter()
+        encoded = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for name in chunks:
+                command = [FFMPEG_PATH, "-y", "-i", os.path.join(tmp_dir, name)]
+                command += encode_arguments(crf, resolution, bitrate, chunk_threads)
+                command.append(os.path.join(tmp_dir, f"encoded_{name}"))
+                futures[pool.submit(_run_ffmpeg, command, cancel_event)] = name
+            for future in as_completed(futures):
+                if not future.result():
+                    return False
+                encoded[futures[future]] = f"encoded_{futures[future]}"
+                if progress_callback:
+                    out_time = min(duration, len(encoded) * segment_seconds)
+                    elapsed = time.perf_counter() - start
+                    speed = out_time / elapsed if elapsed > 0 else 0.0
+                    progress_callback({"input": input_path, "out_time": out_time, "fps": 0.0, "speed": speed,
+                                       "percent": out_time / duration * 100,
+                                       "eta": (duration - out_time) / speed if speed > 0 else None,
+                                       "done": len(encoded) == len(chunks)})
+
+        list_path = os.path.join(tmp_dir, "segments.txt")
+        with open(list_path, "w") as file:
+            for name in chunks:
+                file.write(f"file '{encoded[name]}'\n")
+        concat_command = [FFMPEG_PATH, "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-i", input_path,
+                          "-map", "0:v:0", "-map", "1:a?", "-c:v", "copy", output_path]
+        if not _run_ffmpeg(concat_command, cancel_event):
+            return False
+
+    verify_segmented(input_path, output_path)
+    return True
+
+def compress_video(input_path, output_path, crf=23, resolution=None, bitrate=None, threads=None, cache=None,
+                   progress_callback=None, cancel_event=None, duration=None, preflight=False, min_savings=0.10,
+                   segmented=False, segment_seconds=SEGMENT_SECONDS, segment_workers=None):
     """
     Compress a video file using FFmpeg.
+    Args:
+        input_path: Path to the original video.
+        output_path: Path to save the compressed video.
+        crf: libx264 constant rate factor (0-51, higher = smaller size).
+        resolution: Optional output size such as "1280x720".
+        bitrate: Optional video bitrate such as "1000k".
+        threads: Optional ffmpeg thread count for this encode.
+        cache: Optional ResultCache; unchanged inputs are copied from it
+            instead of being re-encoded.
+        progress_callback: Optional function called on this thread with a
+            progress_info dict each time ffmpeg reports progress.
+        cancel_event: Optional threading.Event; once set, ffmpeg is killed
+            and the partial output removed.
+        duration: Input duration in seconds for ETA, probed if not given.
+        preflight: Boolean, if True probes the input and sample-encodes a few
+            short segments first. Inputs predicted to grow or to save less
+            than min_savings (a fraction) are copied through untouched.
+            Decisions and predicted vs actual sizes go to PREFLIGHT_LOG.
+        segmented: Boolean, if True inputs of at least MIN_SEGMENTED_DURATION
+            are split at keyframes into segment_seconds chunks that are
+            encoded concurrently by segment_workers ffmpeg processes (see
+            encode_segmented). Shorter inputs, or results that fail
+            verification, use a single process.
+    Returns:
+        A dict with the output path (with the input's extension when
+        pre-flight copied it through), whether the result came from the
+        cache, whether pre-flight skipped the encode, whether it was segmented and the
+        seconds spent per stage, or False on failure or cancellation. Every
+        call is recorded in metrics.REGISTRY.
     """
-    ffmpeg_path = r"C:\Users\HP\Desktop\imgvid\ffmpeg-7.1-full_build\ffmpeg-7.1-full_build\bin\ffmpeg.exe"
+    timer = StageTimer()
+    stats = {"output": output_path, "cached": False, "skipped": False, "segmented": False}
     try:
+        bytes_in = os.path.getsize(input_path)
         # Ensure output path directory exists
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
-        command = [
-            ffmpeg_path,
-            "-y",  # Overwrite existing output file
-            "-i", input_path,
-            "-vcodec", "libx264",
-            "-crf", str(crf),
-            output_path
-        ]
-
-        print("Running FFmpeg Command:", " ".join(command))
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        print("FFmpeg Output:", result.stdout)
-        return True
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        cache_key = None
+        if cache is not None:
+            with timer.stage("cache"):
+                cache_key = cache.key(input_path, video_cache_params(crf, resolution, bitrate))
+                hit = cache.get(cache_key, output_path)
+            if hit:
+                logger.info("Cache hit: %s", input_path)
+                REGISTRY.record("video", input_path, "cached", bytes_in, os.path.getsize(output_path), timer.stages)
+                return dict(stats, cached=True, stages=timer.stages)
+
+        preflight_record = None
+        if preflight:
+            with timer.stage("probe"):
+                info = probe_video(input_path)
+            if info and info["duration"] > 0:
+                duration = info["duration"]
+                error = None
+                with timer.stage("preflight"):
+                    try:
+                        predicted = predict_size(input_path, duration, crf, resolution, bitrate, threads)
+                    except (subprocess.CalledProcessError, OSError) as e:
+                        # Pre-flight only saves work; without a prediction, encode as usual
+                        error = getattr(e, "stderr", None) or str(e)
+                        logger.warning("Pre-flight failed, encoding anyway: %s: %s", input_path, error)
+                        predicted = None
+                predicted_savings = 1 - predicted / info["size"] if predicted else 0.0
+                skip = predicted is not None and predicted_savings < min_savings
+                preflight_record = dict(info, input=input_path, predicted_size=predicted,
+                                        predicted_savings=predicted_savings, min_savings=min_savings,
+                                        decision="error" if error else "skip" if skip else "encode",
+                                        params=video_cache_params(crf, resolution, bitrate), time=time.time())
+                if error:
+                    preflight_record["error"] = error
+                stats["predicted_size"] = predicted
+                if skip:
+                    # The copy keeps the source container, so it keeps its extension too
+                    output_path = os.path.splitext(output_path)[0] + os.path.splitext(input_path)[1]
+                    stats["output"] = output_path
+                    with timer.stage("write"):
+                        shutil.copyfile(input_path, output_path)
+                    preflight_record["actual_size"] = None
+                    _log_preflight(preflight_record)
+                    logger.info("Pre-flight skip (%.0f%% predicted savings): %s", predicted_savings * 100, input_path)
+                    REGISTRY.record("video", input_path, "skipped", bytes_in, bytes_in, timer.stages)
+                    return dict(stats, skipped=True, stages=timer.stages)
+
+        if (progress_callback or segmented) and duration is None:
+            with timer.stage("probe"):
+                duration = probe_duration(input_path)
+
+        completed = None
+        with timer.stage("encode"):
+            if segmented and duration >= MIN_SEGMENTED_DURATION:
+                try:
+                    completed = encode_segmented(input_path, output_path, duration, crf, resolution, bitrate,
+                                                 threads, segment_seconds, segment_workers, progress_callback,
+                                                 cancel_event)
+                except (RuntimeError, subprocess.CalledProcessError) as e:
+                    logger.warning("Segmented encode failed, falling back to a single process: %s", e)
+            stats["segmented"] = completed is not None
+            if completed is None:
+                completed = _encode_single(input_path, output_path,
+                                           encode_arguments(crf, resolution, bitrate, threads),
+                                           duration, progress_callback, cancel_event)
+        if not completed:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            logger.info("Cancelled: %s", input_path)
+            REGISTRY.record("video", input_path, "cancelled", bytes_in, stages=timer.stages)
+            return False
+
+        bytes_out = os.path.getsize(output_path)
+        if cache_key:
+            with timer.stage("cache"):
+                cache.put(cache_key, output_path)
+        if preflight_record:
+            preflight_record["actual_size"] = bytes_out
+            _log_preflight(preflight_record)
+        REGISTRY.record("video", input_path, "ok", bytes_in, bytes_out, timer.stages)
+        return dict(stats, stages=timer.stages)
+    except subprocess.CalledProcessError as e:
+        logger.error("Error compressing video %s: %s", input_path, e.stderr)
+        REGISTRY.record("video", input_path, "failed", stages=timer.stages, error=e)
+        return False
+    except Exception as e:
+        logger.error("Unexpected error compressing video %s: %s", input_path, e)
+        REGISTRY.record("video", input_path, "failed", stages=timer.stages, error=e)
+        return False
+
+def needs_seeking(source, max_boxes=64):
+    """
+    True if an MP4/MOV stream keeps its moov atom after mdat, so ffmpeg
+    would have to seek to the end before decoding anything. Walks the
+    top-level boxes of a seekable file-like object and restores its position.
+    """
+    position = source.tell()
+    try:
+        offset = position
+        for _ in range(max_boxes):
+            source.seek(offset)
+            header = source.read(16)
+            if len(header) < 8:
+                return False
+            size, kind = int.from_bytes(header[:4], "big"), header[4:8]
+            if kind == b"moov":
+                return False
+            if kind == b"mdat":
+                return True
+            if size == 1 and len(header) == 16:
+                size = int.from_bytes(header[8:16], "big")
+            if size < 8 or (offset == position and kind not in ISO_LEADING_BOXES):
+                # Not an ISO media file (e.g. AVI), which ffmpeg reads from a pipe
+                return False
+            offset += size
+        return False
+    finally:
+        source.seek(position)
+
+def _feed_stdin(source, stdin, fed, chunk_size=1024 * 1024):
+    try:
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            stdin.write(chunk)
+            fed[0] += len(chunk)
+    except (BrokenPipeError, OSError, ValueError):
+        pass  # ffmpeg exited early; its return code reports why
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+def compress_video_stream(source, output, crf=23, resolution=None, bitrate=None, threads=None, cache=None,
+                          progress_callback=None, cancel_event=None, duration=None, spill_dir=None):
+    """
+    Compress a video held in memory by piping it through ffmpeg: the input
+    goes in over stdin and fragmented MP4 comes back on stdout, so neither
+    side touches the disk. MP4/MOV inputs with the moov atom at the end
+    (see needs_seeking) are spilled to a temporary file first, which is
+    removed afterwards.
+    Args:
+        source: Bytes-like or seekable binary file-like object (e.g. an upload).
+        output: Path or writable binary file-like object for the result.
+        crf, resolution, bitrate, threads: As for compress_video.
+        cache: Optional ResultCache, consulted with the input's bytes. Only
+            used with a path output.
+        progress_callback: Optional function called on this thread with a
+            progress_info dict. Without a duration, percent and ETA follow
+            the share of the input fed to ffmpeg so far.
+        cancel_event: Optional threading.Event; once set, ffmpeg is killed.
+        duration: Input duration in seconds, if known.
+        spill_dir: Directory for the spill file (default: the system temp dir).
+    Returns:
+        A dict like compress_video's plus whether the input was spilled to
+        disk, or False on failure or cancellation.
+    """
+    timer = StageTimer()
+    name = getattr(source, "name", "<stream>")
+    stats = {"output": output, "cached": False, "skipped": False, "segmented": False, "spilled": False}
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    source.seek(0)
+    bytes_in = source.seek(0, os.SEEK_END)
+    source.seek(0)
+    path_output = isinstance(output, (str, os.PathLike))
+    try:
+        cache_key = None
+        if cache is not None and path_output:
+            with timer.stage("cache"):
+                cache_key = cache.key(source, video_cache_params(crf, resolution, bitrate))
+                hit = cache.get(cache_key, output)
+            if hit:
+                logger.info("Cache hit: %s", name)
+                REGISTRY.record("video", name, "cached", bytes_in, os.path.getsize(output), timer.stages)
+                return dict(stats, cached=True, stages=timer.stages)
+
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+            input_arg = "pipe:0"
+            if needs_seeking(source):
+                with timer.stage("spill"):
+                    input_arg = os.path.join(tmp_dir, "input" + os.path.splitext(name)[1])
+                    with open(input_arg, "wb") as file:
+                        shutil.copyfileobj(source, file, 1024 * 1024)
+                stats["spilled"] = True
+                logger.info("moov atom after mdat, spilled to disk: %s", name)
+                if duration is None:
+                    duration = probe_duration(input_arg) or None
+
+            command = [FFMPEG_PATH, "-y", "-nostats", "-loglevel", "error", "-i", input_arg]
+            command += encode_arguments(crf, resolution, bitrate, threads)
+            command += ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4",
+                        "-progress", "pipe:2", "pipe:1"]
+            logger.info("Running FFmpeg Command: %s", " ".join(command))
+
+            with timer.stage("encode"):
+                completed, bytes_out = _pipe_ffmpeg(command, source if input_arg == "pipe:0" else None,
+                                                   bytes_in, output, name, duration, progress_callback,
+                                                   cancel_event)
+        if not completed:
+            if path_output and os.path.exists(output):
+                os.remove(output)
+            logger.info("Cancelled: %s", name)
+            REGISTRY.record("video", name, "cancelled", bytes_in, stages=timer.stages)
+            return False
+
+        if cache_key:
+            with timer.stage("cache"):
+                cache.put(cache_key, output)
+        REGISTRY.record("video", name, "ok", bytes_in, bytes_out, timer.stages)
+        return dict(stats, stages=timer.stages)
     except subprocess.CalledProcessError as e:
-        print("Error compressing video:", e.stderr)
+        logger.error("Error compressing video %s: %s", name, e.stderr)
+        REGISTRY.record("video", name, "failed", stages=timer.stages, error=e)
         return False
     except Exception as e:
-        print(f"Unexpected Error: {e}")
+        logger.error("Unexpected error compressing video %s: %s", name, e)
+        REGISTRY.record("video", name, "failed", stages=timer.stages, error=e)
         return False
+
+def _pipe_ffmpeg(command, source, bytes_in, output, name, duration, progress_callback, cancel_event,
+                 chunk_size=1024 * 1024):
+    """
+    Run a stdin/stdout ffmpeg command, copying stdout to output and relaying
+    -progress reports (on stderr) to progress_callback on this thread.
+    Stdout is copied on its own thread, so cancellation and progress don't
+    wait for output to arrive.
+    Returns:
+        (completed, bytes written); completed is False if cancelled.
+    """
+    fed = [0]
+    written = [0]
+    reports = queue.Queue()
+    errors = []
+    sink_errors = []
+
+    def read_stderr(stderr):
+        fields = {}
+        for line in stderr:
+            key, sep, value = line.decode(errors="replace").strip().partition("=")
+            if not sep:
+                errors.append(line.decode(errors="replace"))
+                continue
+            fields[key] = value
+            if key == "progress":
+                reports.put(dict(fields))
+
+    def copy_stdout(stdout, sink):
+        try:
+            # read1 returns whatever is available instead of waiting for a full chunk
+            for chunk in iter(lambda: stdout.read1(chunk_size), b""):
+                sink.write(chunk)
+                written[0] += len(chunk)
+        except Exception as e:
+            sink_errors.append(e)
+            process.kill()
+
+    with subprocess.Popen(command, stdin=subprocess.PIPE if source else subprocess.DEVNULL,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        threads = [threading.Thread(target=read_stderr, args=(process.stderr,), daemon=True)]
+        if source:
+            threads.append(threading.Thread(target=_feed_stdin, args=(source, process.stdin, fed), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        sink = open(output, "wb") if isinstance(output, (str, os.PathLike)) else output
+        copier = threading.Thread(target=copy_stdout, args=(process.stdout, sink), daemon=True)
+        copier.start()
+        cancelled = False
+        try:
+            while copier.is_alive():
+                if cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                    process.kill()
+                    break
+                try:
+                    fields = reports.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if progress_callback:
+                    info = progress_info(name, fields, duration)
+                    if duration is None and source and bytes_in:
+                        # Without a duration, the share of input consumed tracks progress
+                        info["percent"] = fed[0] / bytes_in * 100
+                        share = info["percent"] / 100
+                        info["eta"] = None
+                        if 0 < share < 1 and info["speed"] > 0:
+                            # out_time / speed is the wall time spent so far
+                            info["eta"] = info["out_time"] / info["speed"] * (1 / share - 1)
+                    progress_callback(info)
+        finally:
+            if copier.is_alive():
+                process.kill()  # progress_callback raised
+            copier.join()
+            if sink is not output:
+                sink.close()
+        returncode = process.wait()
+        for thread in threads:
+            thread.join()
+
+    if sink_errors:
+        raise sink_errors[0]
+    bytes_out = written[0]
+    if cancelled:
+        return False, bytes_out
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stderr="".join(errors))
+    return True, bytes_out
@@ -0,0 +1,166 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import os
+import threading
+import time
+
+from video_compressor import compress_video, probe_duration
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds between progress_callback rounds while jobs are running
+PROGRESS_INTERVAL = 0.5
+
+
+def default_thread_budget():
+    return os.cpu_count() or 1
+
+
+def default_parallel_jobs(total_threads):
+    # libx264 stops scaling well past a handful of threads per encode,
+    # so a wide budget is better spent on more concurrent ffmpeg processes
+    return max(1, total_threads // 4)
+
+
+def allocate_threads(duration, free_threads, upcoming_durations):
+    """
+    Threads for a job about to start: its duration-weighted share of the free
+    threads, split with the jobs that will fill the other free slots.
+    """
+    total = duration + sum(upcoming_durations)
+    if total > 0:
+        share = free_threads * duration / total
+    else:
+        share = free_threads / (1 + len(upcoming_durations))
+    return max(1, min(free_threads, round(share)))
+
+
+def _cancelled_result(input_path, output_path, threads=None):
+    return {"input": input_path, "output": output_path, "ok": False, "cached": False, "cancelled": True,
+            "skipped": False, "stages": {}, "before_size": None, "after_size": None, "threads": threads}
+
+
+def compress_job(input_path, output_path, threads, duration, options):
+    """
+    Compress one video with a thread count and known duration (options are
+    compress_video keyword arguments). Returns a result dict as yielded by
+    compress_videos.
+    """
+    before_size = os.path.getsize(input_path) // 1024
+    start = time.perf_counter()
+    stats = compress_video(input_path, output_path, threads=threads, duration=duration, **options)
+    seconds = time.perf_counter() - start
+    cancel_event = options.get("cancel_event")
+    if not stats and cancel_event is not None and cancel_event.is_set():
+        return _cancelled_result(input_path, output_path, threads)
+    # Pre-flight skips keep the input's extension
+    output_path = stats["output"] if stats else output_path
+    after_size = os.path.getsize(output_path) // 1024 if stats else None
+    result = {"input": input_path, "output": output_path, "ok": bool(stats), "cancelled": False,
+              "cached": False, "skipped": False, "stages": {}, "before_size": before_size,
+              "after_size": after_size, "threads": threads, "duration": duration,
+              "seconds": seconds, "speed": duration / seconds if seconds > 0 else 0.0,
+              "mb_per_s": before_size / 1024 / seconds if seconds > 0 else 0.0}
+    if stats:
+        result.update(stats)
+    return result
+
+
+def compress_videos(jobs, max_parallel=None, total_threads=None, cache=None, progress_callback=None,
+                    cancel_event=None, **options):
+    """
+    Run several ffmpeg encodes at once, yielding results as they finish.
+    Longest inputs start first, and each job's -threads is its duration-weighted
+    share of the threads not used by running jobs.
+    Args:
+        jobs: Iterable of (input_path, output_path) pairs.
+        max_parallel: Number of concurrent ffmpeg processes.
+        total_threads: Global thread budget (defaults to the CPU count).
+        cache: Optional ResultCache passed to compress_video.
+        progress_callback: Optional function called with each running job's
+            latest progress_info dict. It runs on the thread iterating this
+            generator, so it may touch UI objects owned by that thread.
+        cancel_event: Optional threading.Event. Once set, running encodes are
+            killed and the remaining jobs are reported as cancelled. Closing
+            the generator early cancels the same way.
+        **options: Keyword arguments passed to compress_video.
+    Yields:
+        A dict per video with input, output, ok, cached, cancelled, skipped,
+        before_size and after_size (KB), threads, duration and seconds,
+        speed (x realtime) and mb_per_s, in completion order.
+    """
+    pending = [(src, dst, probe_duration(src)) for src, dst in jobs]
+    if not pending:
+        return
+    pending.sort(key=lambda job: job[2], reverse=True)
+    total_threads = total_threads or default_thread_budget()
+    max_parallel = max(1, min(max_parallel or default_parallel_jobs(total_threads), total_threads, len(pending)))
+
+    cancel_event = cancel_event or threading.Event()
+    latest = {}
+    latest_lock = threading.Lock()
+
+    def record_progress(info):
+        with latest_lock:
+            latest[info["input"]] = info
+
+    job_options = dict(options, cache=cache, cancel_event=cancel_event,
+                       progress_callback=record_progress if progress_callback else None)
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        running = {}
+        free_threads = total_threads
+        try:
+            while pending or running:
+                if cancel_event.is_set():
+                    while pending:
+                        src, dst, _ = pending.pop(0)
+                        yield _cancelled_result(src, dst)
+                while pending and len(running) < max_parallel and free_threads > 0:
+                    src, dst, duration = pending.pop(0)
+                    upcoming = [job[2] for job in pending[:max_parallel - len(running) - 1]]
+                    threads = allocate_threads(duration, free_threads, upcoming)
+                    future = pool.submit(compress_job, src, dst, threads, duration, job_options)
+                    running[future] = (src, dst, threads)
+                    free_threads -= threads
+                if not running:
+                    break
+
+                done, _ = wait(running, timeout=PROGRESS_INTERVAL if progress_callback else None,
+                               return_when=FIRST_COMPLETED)
+                if progress_callback:
+                    with latest_lock:
+                        updates = list(latest.values())
+                        latest.clear()
+                    for info in updates:
+                        progress_callback(info)
+                for future in done:
+                    src, dst, threads = running.pop(future)
+                    free_threads += threads
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error("Error compressing video %s: %s", src, e)
+                        result = {"input": src, "output": dst, "ok": False, "cached": False, "cancelled": False,
+                                  "skipped": False, "stages": {}, "before_size": None, "after_size": None,
+                                  "threads": threads}
+                    yield result
+        finally:
+            # Kill running encodes rather than waiting on them when the
+            # consumer stops early (e.g. a Streamlit rerun)
+            if running:
+                cancel_event.set()
+
+
+def throughput_summary(results, wall_seconds):
+    """
+    Aggregate throughput of a finished batch from its per-job results.
+    """
+    finished = [r for r in results if r["ok"]]
+    media_seconds = sum(r["duration"] for r in finished)
+    input_mb = sum(r["before_size"] for r in finished) / 1024
+    return {"jobs": len(finished), "failed": len(results) - len(finished),
+            "wall_seconds": wall_seconds, "media_seconds": media_seconds,
+            "speed": media_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+            "mb_per_s": input_mb / wall_seconds if wall_seconds > 0 else 0.0}